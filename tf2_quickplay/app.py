@@ -1,21 +1,30 @@
+import array
 import asyncio
+import base64
 import datetime
+import gzip
+import hashlib
 import io
+import ipaddress
 import math
 import os
 import random
+import re
 import sys
 import tarfile
 import time
 import traceback
 import urllib.request
+from bisect import bisect_left
 from collections import defaultdict
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import TypedDict
+from typing import NamedTuple, TypedDict
 
 import a2s
 import aiohttp
+import brotli
 import cachetools
 import geoip2
 import geoip2.database
@@ -24,6 +33,7 @@ import orjson
 import PIL
 import tinydb
 import vdf
+from aiohttp import web
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
@@ -64,10 +74,15 @@ CONTINENTS = {
     6: set(["AS", "EU"]),
     7: set(["AF"]),
 }
+ALL_CONTINENTS = set().union(*CONTINENTS.values())
 
 DEBUG = os.getenv("QUICKPLAY_DEBUG") is not None
 DEBUG_SKIP_SERVERS = os.getenv("QUICKPLAY_DEBUG_SKIP_SERVERS") is not None
 
+# snapshots are only served over HTTP when a port is given
+HTTP_HOST = os.getenv("QUICKPLAY_HTTP_HOST", "127.0.0.1")
+HTTP_PORT = os.getenv("QUICKPLAY_HTTP_PORT")
+
 OVERVIEW_INTERVAL = 300
 
 CDN_BASE_URL = "https://media.steampowered.com"
@@ -83,7 +98,8 @@ MAX_NORMAL_PLAYERS = 33
 
 SERVER_HEADROOM = 1
 
-DB = tinydb.TinyDB(Path("./db.json"))
+DB_PATH = Path("./db.json")
+DB = tinydb.TinyDB(DB_PATH)
 rep_table = DB.table("rep")
 ban_table = DB.table("bans")
 geo_table = DB.table("geo")
@@ -394,7 +410,164 @@ PREFIX_TO_GAMEMODE = {
 
 TIMESTAMP_TIMEZONE = datetime.timezone.utc
 
-player_count_history = cachetools.TTLCache(maxsize=4000, ttl=60 * 60)
+PLAYER_HISTORY_SLOT_TIME = 60
+PLAYER_HISTORY_SLOTS = 60
+PLAYER_HISTORY_EMPTY = 0x7FFF
+
+
+class PlayerCountHistory:
+    """
+    Player counts of every server over a rolling window, in one fixed size buffer.
+    Each slot_time seconds has a column of slots, one per server row, used as a ring.
+    A slot holds the lowest count seen during it, which is all the trend bonus
+    needs: the lowest of these is the lowest count over the window.
+    """
+
+    def __init__(self, capacity: int, slots: int, slot_time: float):
+        self.capacity = capacity
+        self.slots = slots
+        self.slot_time = slot_time
+        self.slot = 0
+        self.rows: dict[str, int] = {}
+        self.free_rows = list(range(capacity - 1, -1, -1))
+        # rows past this have never been used
+        self.used_rows = 0
+        # column major, so each column is contiguous
+        self.counts = array.array("h", [PLAYER_HISTORY_EMPTY]) * (capacity * slots)
+        # the last slot each row was recorded in
+        self.last_seen = array.array("q", [0]) * capacity
+        # the slot each column currently holds, -1 if empty
+        self.columns = array.array("q", [-1]) * slots
+        self.empty_row = array.array("h", [PLAYER_HISTORY_EMPTY]) * slots
+        self.empty_column = array.array("h", [PLAYER_HISTORY_EMPTY]) * capacity
+
+    def advance(self, now: float):
+        """
+        Moves to the slot for the current time, expiring slots that left the window.
+        """
+        self.slot = int(now // self.slot_time)
+        current = self.slot % self.slots
+        oldest = self.slot - self.slots
+        for column in range(self.slots):
+            held = self.columns[column]
+            if column == current:
+                if held == self.slot:
+                    continue
+                self.columns[column] = self.slot
+            elif held == -1 or oldest < held <= self.slot:
+                continue
+            else:
+                self.columns[column] = -1
+            start = column * self.capacity
+            self.counts[start : start + self.capacity] = self.empty_column
+
+    def record(self, steamid: str, count: int):
+        row = self.rows.get(steamid)
+        if row is None:
+            row = self.add_row(steamid)
+            if row < 0:
+                return
+        # bots can outnumber the reported players, and lowest() needs counts >= 0
+        count = max(count, 0)
+        idx = self.slot % self.slots * self.capacity + row
+        if count < self.counts[idx]:
+            self.counts[idx] = count
+        self.last_seen[row] = self.slot
+
+    def add_row(self, steamid: str) -> int:
+        if not self.free_rows:
+            self.expire_rows()
+            if not self.free_rows:
+                return -1
+        row = self.free_rows.pop()
+        self.used_rows = max(self.used_rows, row + 1)
+        self.counts[row :: self.capacity] = self.empty_row
+        self.rows[steamid] = row
+        return row
+
+    def expire_rows(self):
+        oldest = self.slot - self.slots
+        for steamid, row in list(self.rows.items()):
+            if self.last_seen[row] <= oldest:
+                del self.rows[steamid]
+                self.free_rows.append(row)
+
+    def to_state(self) -> dict:
+        used = self.used_rows
+        counts = b"".join(
+            self.counts[start : start + used].tobytes()
+            for start in range(0, len(self.counts), self.capacity)
+        )
+        return {
+            "slots": self.slots,
+            "slot_time": self.slot_time,
+            "major": "column",
+            "slot": self.slot,
+            "rows": self.rows,
+            "counts": base64.b64encode(counts).decode(),
+            "last_seen": list(self.last_seen[:used]),
+            "columns": list(self.columns),
+        }
+
+    def load_state(self, state: dict) -> bool:
+        if (
+            state["slots"] != self.slots
+            or state["slot_time"] != self.slot_time
+            or state.get("major") != "column"
+            or len(state["last_seen"]) > self.capacity
+        ):
+            return False
+        counts = array.array("h")
+        counts.frombytes(base64.b64decode(state["counts"]))
+        self.used_rows = used = len(state["last_seen"])
+        for column in range(self.slots):
+            start = column * self.capacity
+            self.counts[start : start + used] = counts[
+                column * used : (column + 1) * used
+            ]
+        self.last_seen[:used] = array.array("q", state["last_seen"])
+        self.columns = array.array("q", state["columns"])
+        self.slot = state["slot"]
+        self.rows = state["rows"]
+        used = set(self.rows.values())
+        self.free_rows = [
+            row for row in range(self.capacity - 1, -1, -1) if row not in used
+        ]
+        return True
+
+    def get_row(self, steamid: str) -> int:
+        return self.rows.get(steamid, -1)
+
+    def lowest(self) -> array.array:
+        """
+        Gets the lowest count in the window for every used row at once.
+        Rows without any counts are PLAYER_HISTORY_EMPTY.
+        Each column is compared as one integer. Counts are below 0x8000, so in
+        (a | 0x8000) - b each 16 bit lane keeps its high bit exactly when a >= b,
+        without borrowing from the next lane.
+        """
+        lowest = array.array("h", [PLAYER_HISTORY_EMPTY]) * self.capacity
+        used = self.used_rows
+        if not used:
+            return lowest
+        counts = memoryview(self.counts)
+        high = int.from_bytes(array.array("H", [0x8000]) * used, sys.byteorder)
+        merged = int.from_bytes(counts[:used], sys.byteorder)
+        for start in range(self.capacity, len(self.counts), self.capacity):
+            column = int.from_bytes(counts[start : start + used], sys.byteorder)
+            greater = (((merged | high) - column) & high) >> 15
+            # spread each lane's flag to 0xffff to select the lower count
+            mask = (greater << 16) - greater
+            merged ^= (merged ^ column) & mask
+        lowest[:used] = array.array(
+            "h", merged.to_bytes(used * lowest.itemsize, sys.byteorder)
+        )
+        return lowest
+
+
+player_count_history = PlayerCountHistory(
+    int(QUERY_LIMIT), PLAYER_HISTORY_SLOTS, PLAYER_HISTORY_SLOT_TIME
+)
 
 PLAYER_TREND_MIN = 0.2  # was 0.5
 PLAYER_TREND_MAX = 0.5  # was 0.85
@@ -439,6 +612,333 @@ FAST_RESPAWN_LIKELY_GAMETYPE = [
 shuffle_score_history = cachetools.TTLCache(maxsize=4000, ttl=60 * 60)
 
 
+class ServerClass(NamedTuple):
+    """
+    The outcome of classifying the static parts of a server.
+    """
+
+    # the reason the server was rejected, or None if accepted
+    removal: str | None
+    gametype: list[str]
+    name: str = ""
+    bonus: float = 0
+    anycast: bool = False
+
+
+class MapInfo(NamedTuple):
+    """
+    Everything about a map that is needed to classify a server running it.
+    """
+
+    prefix: str
+    forced_custom: bool
+    expected_tag: str | None
+    beta: bool
+    # the reason servers on this map are rejected, or None if allowed
+    removal: str | None
+
+
+class RuleGroup(NamedTuple):
+    """
+    The compiled rules applied to a group of servers.
+    """
+
+    flags: frozenset[str]
+    score_adj: float
+    tags_exc: tuple[str, ...]
+    forced_tags: tuple[str, ...]
+    # name pattern to ordered (tag, add) edits
+    name_to_tags: tuple[tuple[str, tuple[tuple[str, bool], ...]], ...]
+
+
+EMPTY_RULE_GROUP = RuleGroup(frozenset(), 0, (), (), ())
+
+
+class NetworkMatch(NamedTuple):
+    """
+    The most specific network entries of each kind containing an address.
+    """
+
+    banned: bool
+    anycast: bool
+    rules_group: RuleGroup | None
+
+
+NO_NETWORK_MATCH = NetworkMatch(False, False, None)
+
+# node layout: zero child, one child, then one slot per kind of entry
+NETWORK_NODE_BANNED = 2
+NETWORK_NODE_ANYCAST = 3
+NETWORK_NODE_RULES_GROUP = 4
+
+
+class NetworkIndex:
+    """
+    A binary prefix tree of IPv4 and IPv6 networks.
+    A lookup walks the address bits once, keeping the longest match for each kind.
+    """
+
+    __slots__ = ("roots",)
+
+    def __init__(self):
+        self.roots = {4: [None] * 5, 6: [None] * 5}
+
+    def insert(self, network: str, slot: int, value) -> bool:
+        try:
+            net = ipaddress.ip_network(network, strict=False)
+        except ValueError:
+            print(f"{network} is not a valid network, skipping")
+            return False
+        bits = net.max_prefixlen
+        address = int(net.network_address)
+        node = self.roots[net.version]
+        for depth in range(1, net.prefixlen + 1):
+            bit = (address >> (bits - depth)) & 1
+            child = node[bit]
+            if child is None:
+                child = [None] * 5
+                node[bit] = child
+            node = child
+        node[slot] = value
+        return True
+
+    def lookup(self, ip: str) -> NetworkMatch:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return NO_NETWORK_MATCH
+        node = self.roots[address.version]
+        value = int(address)
+        shift = address.max_prefixlen
+        banned = None
+        anycast = None
+        rules_group = None
+        while True:
+            if node[NETWORK_NODE_BANNED] is not None:
+                banned = node[NETWORK_NODE_BANNED]
+            if node[NETWORK_NODE_ANYCAST] is not None:
+                anycast = node[NETWORK_NODE_ANYCAST]
+            if node[NETWORK_NODE_RULES_GROUP] is not None:
+                rules_group = node[NETWORK_NODE_RULES_GROUP]
+            shift -= 1
+            if shift < 0:
+                break
+            node = node[(value >> shift) & 1]
+            if node is None:
+                break
+        if banned is None and anycast is None and rules_group is None:
+            return NO_NETWORK_MATCH
+        return NetworkMatch(banned is True, anycast is True, rules_group)
+
+
+class ServerRules(NamedTuple):
+    """
+    An immutable snapshot of the ban, anycast and rules group tables.
+    """
+
+    banned_ids: frozenset[str]
+    # matches any banned name substring, or None if there are none
+    banned_names: re.Pattern | None
+    banned_tags: frozenset[str]
+    # ip bans, anycast ranges and rules groups by network
+    networks: NetworkIndex
+    id_to_rules_group: dict[str, RuleGroup]
+
+
+class ServerRecord:
+    """
+    A server as it moves through the quickplay cycle.
+    It is only converted to its published shape when serialized.
+    """
+
+    __slots__ = (
+        "addr",
+        "steamid",
+        "name",
+        "appid",
+        "gamedir",
+        "product",
+        "version",
+        "region",
+        "players",
+        "max_players",
+        "bots",
+        "map",
+        "gametype",
+        "score",
+        "point",
+        "ping",
+        "removal",
+        "continent",
+    )
+
+    def __init__(
+        self,
+        addr: str,
+        steamid: str,
+        name: str,
+        appid: int,
+        gamedir: str,
+        product: str,
+        version: str,
+        region: int,
+        players: int,
+        max_players: int,
+        bots: int,
+        map: str | None,
+        gametype: str | list[str],
+    ):
+        self.addr = addr
+        self.steamid = steamid
+        self.name = name
+        self.appid = appid
+        self.gamedir = gamedir
+        self.product = product
+        self.version = version
+        self.region = region
+        self.players = players
+        self.max_players = max_players
+        self.bots = bots
+        self.map = map
+        self.gametype = gametype
+        self.score = 0.0
+        self.point = None
+        self.ping = 0.0
+        self.removal = None
+        self.continent = None
+
+    @classmethod
+    def from_steam(cls, server: dict) -> "ServerRecord":
+        return cls(
+            server["addr"],
+            server["steamid"],
+            server["name"],
+            server["appid"],
+            server["gamedir"],
+            server["product"],
+            server["version"],
+            server.get("region", 255),
+            server["players"],
+            server["max_players"],
+            server["bots"],
+            server.get("map"),
+            server.get("gametype", ""),
+        )
+
+    def rejected(self, removal: str, gametype: list[str]) -> "ServerRecord":
+        """
+        Copies the server as a debug rejection.
+        """
+        record = ServerRecord(
+            self.addr,
+            self.steamid,
+            self.name,
+            self.appid,
+            self.gamedir,
+            self.product,
+            self.version,
+            self.region,
+            self.players,
+            self.max_players,
+            self.bots,
+            self.map,
+            gametype,
+        )
+        record.score = -999
+        record.removal = removal
+        return record
+
+    def to_state(self) -> list:
+        return [getattr(self, slot) for slot in ServerRecord.__slots__]
+
+    @classmethod
+    def from_state(cls, state: list) -> "ServerRecord":
+        record = cls.__new__(cls)
+        for slot, value in zip(ServerRecord.__slots__, state):
+            setattr(record, slot, value)
+        # older states don't have the newer slots
+        for slot in ServerRecord.__slots__[len(state) :]:
+            setattr(record, slot, None)
+        return record
+
+    def to_json(self) -> dict:
+        if self.removal is not None:
+            return {
+                "score": self.score,
+                "removal": self.removal,
+                "addr": self.addr,
+                "steamid": self.steamid,
+                "name": self.name,
+                "players": self.players,
+                "max_players": self.max_players,
+                "bots": self.bots,
+                "map": self.map,
+                "gametype": self.gametype,
+            }
+        return {
+            "addr": self.addr,
+            "steamid": self.steamid,
+            "name": self.name,
+            "players": self.players,
+            "max_players": self.max_players,
+            "bots": self.bots,
+            "map": self.map,
+            "gametype": self.gametype,
+            "score": self.score,
+            "point": self.point,
+            "ping": self.ping,
+        }
+
+
+class ServerRanking:
+    """
+    Servers ordered by descending score, overall and per gamemode tag.
+    """
+
+    __slots__ = ("servers", "tag_servers")
+
+    def __init__(self, servers: list[ServerRecord]):
+        # already sorted, so one pass keeps each tag in the same order
+        self.servers = servers
+        self.tag_servers: dict[str, list[ServerRecord]] = {}
+        for server in servers:
+            for tag in ANY_VALID_TAGS.intersection(server.gametype):
+                self.tag_servers.setdefault(tag, []).append(server)
+
+    def __len__(self) -> int:
+        return len(self.servers)
+
+    def __iter__(self):
+        return iter(self.servers)
+
+    def ranked(self, tag: str | None = None) -> list[ServerRecord]:
+        if tag is None:
+            return self.servers
+        return self.tag_servers.get(tag, [])
+
+    def top(self, k: int, tag: str | None = None) -> list[ServerRecord]:
+        return self.ranked(tag)[:k]
+
+
+# rejections that aren't reported even when debugging
+SILENT_REMOVALS = set(["outofdate", "nomap", "notags"])
+
+# server classifications keyed by address, with the fingerprint of their static inputs
+server_class_cache = cachetools.TTLCache(maxsize=20000, ttl=60 * 60)
+
+# A2S timeouts are derived from each server's own RTT history
+A2S_TIMEOUT_MIN = 0.25
+A2S_TIMEOUT_MAX = 3.0
+A2S_TIMEOUT_MARGIN = 0.15
+A2S_TIMEOUT_RTT_SCALE = 2.0
+A2S_TIMEOUT_PERCENTILE = 0.95
+A2S_RTT_SAMPLES = 16
+A2S_RTT_MIN_SAMPLES = 4
+
+# last RTT samples per steamid, in milliseconds
+rtt_history = cachetools.TTLCache(maxsize=20000, ttl=24 * 60 * 60)
+
+
 def utcnow() -> datetime.datetime:
     return datetime.datetime.now(tz=TIMESTAMP_TIMEZONE)
 
@@ -721,7 +1221,7 @@ THUMBNAIL_UPDATE_INTERVAL = datetime.timedelta(hours=24)
 
 
 async def req_items_game(
-    api_session: aiohttp.ClientSession, cdn_session: aiohttp.ClientSession
+    steam_requests: "SteamRequests", cdn_session: aiohttp.ClientSession
 ) -> tuple[dict, bool, int]:
     global last_overview_resp
     global next_overview_resp_time
@@ -732,46 +1232,519 @@ async def req_items_game(
     if last_items_game_resp is not None and current_time < next_overview_resp_time:
         return last_items_game_resp, updated, last_server_version
     try:
-        async with api_session.get(
+        body = await steam_requests.get(
             "/IEconItems_440/GetSchemaOverview/v1/", params=STEAM_API_PARAM
-        ) as resp:
-            body = await resp.read()
-            body = orjson.loads(body)
-            new_overview_resp: str | None = body.get("result", EMPTY_DICT).get(
-                "items_game_url"
+        )
+        body = orjson.loads(body)
+        new_overview_resp: str | None = body.get("result", EMPTY_DICT).get(
+            "items_game_url"
+        )
+        if new_overview_resp:
+            new_overview_resp = new_overview_resp.replace(
+                "http://media.steampowered.com", ""
             )
-            if new_overview_resp:
-                new_overview_resp = new_overview_resp.replace(
-                    "http://media.steampowered.com", ""
-                )
-                next_overview_resp_time = current_time + OVERVIEW_INTERVAL + chaos()
-                if new_overview_resp != last_overview_resp:
-                    last_overview_resp = new_overview_resp
-                    async with cdn_session.get(last_overview_resp) as items_game_resp:
-                        items_game_body = await items_game_resp.text(encoding="utf-8")
-                        updated = True
-                        last_items_game_resp = vdf.loads(
-                            items_game_body, mapper=vdf.VDFDict
-                        )["items_game"]
-        async with api_session.get(
+            next_overview_resp_time = current_time + OVERVIEW_INTERVAL + chaos()
+            if new_overview_resp != last_overview_resp:
+                last_overview_resp = new_overview_resp
+                async with cdn_session.get(last_overview_resp) as items_game_resp:
+                    items_game_body = await items_game_resp.text(encoding="utf-8")
+                    updated = True
+                    last_items_game_resp = vdf.loads(
+                        items_game_body, mapper=vdf.VDFDict
+                    )["items_game"]
+        body = await steam_requests.get(
             "/IGCVersion_440/GetServerVersion/v1/", params=STEAM_API_PARAM
-        ) as resp:
-            body = await resp.read()
-            body = orjson.loads(body)
-            server_version = body.get("result", EMPTY_DICT).get("min_allowed_version")
-            if server_version:
-                last_server_version = server_version
+        )
+        body = orjson.loads(body)
+        server_version = body.get("result", EMPTY_DICT).get("min_allowed_version")
+        if server_version:
+            last_server_version = server_version
     except Exception:
         traceback.print_exc()
     return last_items_game_resp, updated, last_server_version
 
 
+def get_a2s_timeout(steamid: str) -> float:
+    """
+    Gets the A2S timeout for a server from a high percentile of its RTT history.
+    Servers without enough history get the global cap.
+    """
+    samples = rtt_history.get(steamid)
+    if samples is None or len(samples) < A2S_RTT_MIN_SAMPLES:
+        return A2S_TIMEOUT_MAX
+    ordered = sorted(samples)
+    idx = min(int(len(ordered) * A2S_TIMEOUT_PERCENTILE), len(ordered) - 1)
+    timeout = ordered[idx] / 1000 * A2S_TIMEOUT_RTT_SCALE + A2S_TIMEOUT_MARGIN
+    return min(max(timeout, A2S_TIMEOUT_MIN), A2S_TIMEOUT_MAX)
+
+
+def record_rtt(steamid: str, rtt: float):
+    """
+    Records an A2S RTT sample (in seconds) for a server.
+    """
+    samples = rtt_history.get(steamid)
+    if samples is None:
+        samples = array.array("H")
+    samples.append(min(int(rtt * 1000), 0xFFFF))
+    if len(samples) > A2S_RTT_SAMPLES:
+        del samples[0]
+    # re-set to refresh the TTL
+    rtt_history[steamid] = samples
+
+
+def forget_rtt(steamid: str):
+    """
+    Drops the RTT history of a server that failed to answer.
+    It may have gotten slower than its timeout, so it gets the global cap until it
+    has enough samples again.
+    """
+    rtt_history.pop(steamid, None)
+
+
+def classify_map(
+    map: str,
+    map_gamemode: dict[str, str],
+    holiday_map_gamemode: dict[int, dict[str, str]],
+) -> MapInfo:
+    map_split = map.split("_")
+    prefix = map_split[0]
+    forced_custom_map = prefix in ALLOWED_CUSTOM_MAP_PREFIXES
+    beta = map in BETA_MAPS
+    if map not in map_gamemode and not forced_custom_map:
+        removal = "badmap"
+        if DEBUG and not DEBUG_SKIP_SERVERS:
+            if prefix == "arena":
+                removal = "arenamap"
+            elif any((map in lookup for lookup in holiday_map_gamemode.values())):
+                removal = "holidaymap"
+            elif prefix in DEFAULT_MAP_PREFIXES and not map.startswith("cp_orange"):
+                removal = "custommap"
+                if len(map_split) > 2:
+                    unversion_name = "_".join(map_split[:-1])
+                    if unversion_name in COMMUNITY_MAPS_UNVERSIONED:
+                        removal = "versionmapdiff"
+        return MapInfo(prefix, forced_custom_map, None, beta, removal)
+    if forced_custom_map:
+        expected_gamemode = None
+    else:
+        expected_gamemode = GAMEMODE_TO_TAG.get(map_gamemode[map])
+    if not expected_gamemode:
+        prefix_gamemode = PREFIX_TO_GAMEMODE.get(prefix)
+        if prefix_gamemode:
+            expected_gamemode = GAMEMODE_TO_TAG.get(prefix_gamemode)
+    return MapInfo(prefix, forced_custom_map, expected_gamemode, beta, None)
+
+
+def compile_rule_group(rules: dict) -> RuleGroup:
+    name_to_tags = []
+    for pattern, tags in rules.get("name_to_tags", {}).items():
+        edits = tuple(
+            (tag[1:], False) if tag.startswith("-") else (tag, True) for tag in tags
+        )
+        name_to_tags.append((pattern, edits))
+    return RuleGroup(
+        frozenset(rules.get("flags", [])),
+        rules.get("score_adj", 0),
+        tuple(rules.get("tags_exc", [])),
+        tuple(rules.get("forced_tags") or []),
+        tuple(name_to_tags),
+    )
+
+
+def load_server_rules() -> ServerRules:
+    """
+    Compiles the ban, anycast and extras tables into lookup structures.
+    """
+    banned_name_search = get_value("names", default=[], table=ban_table)
+    banned_names = None
+    if banned_name_search:
+        banned_names = re.compile("|".join(map(re.escape, banned_name_search)))
+    # entries may be single addresses or CIDR ranges
+    networks = NetworkIndex()
+    for ip in get_value("ips", default=[], table=ban_table):
+        networks.insert(ip, NETWORK_NODE_BANNED, True)
+    for ip in get_value("ips", default=[], table=anycast_table):
+        networks.insert(ip, NETWORK_NODE_ANYCAST, True)
+    id_to_rules_group = {}
+    for rule_group in get_value("rule_groups", default=[], table=extras_table):
+        rules = compile_rule_group(rule_group.get("rules", {}))
+        for ip in rule_group.get("ips", []):
+            networks.insert(ip, NETWORK_NODE_RULES_GROUP, rules)
+        for steamid in rule_group.get("ids", []):
+            id_to_rules_group[steamid] = rules
+    return ServerRules(
+        frozenset(get_value("ids", default=[], table=ban_table)),
+        banned_names,
+        frozenset(get_value("tags", default=[], table=ban_table)),
+        networks,
+        id_to_rules_group,
+    )
+
+
+def get_db_mtime() -> int:
+    try:
+        return DB_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def reopen_db():
+    """
+    Reopens the DB and its tables.
+    Edits may replace the file rather than write to it, which the open handle won't see.
+    """
+    global DB, rep_table, ban_table, geo_table, anycast_table, extras_table
+    db = tinydb.TinyDB(DB_PATH)
+    DB.close()
+    DB = db
+    rep_table = DB.table("rep")
+    ban_table = DB.table("bans")
+    geo_table = DB.table("geo")
+    anycast_table = DB.table("anycast")
+    extras_table = DB.table("extras")
+
+
+SERVERS_PATH = Path("servers.json")
+STATE_PATH = Path("quickplay_state.json.br")
+STATE_SAVE_INTERVAL = 60
+# don't publish a saved snapshot on start if it is older than this
+STATE_MAX_PUBLISH_AGE = 10 * 60
+
+
+def write_atomic(path: Path, data: bytes):
+    """
+    Writes a file so that readers only ever see the old or the new contents.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_files(files: dict[Path, bytes]):
+    for path, data in files.items():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(path, data)
+
+
+# writes queued for the output thread before the collector waits on it
+OUTPUT_MAX_PENDING = 8
+
+
+class OutputWriter:
+    """
+    Runs file output on a dedicated thread, in the order it was submitted.
+    Submitting waits while too many writes are pending, so a slow disk holds back
+    the collector instead of piling up data in memory.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="output")
+        self.slots = asyncio.Semaphore(OUTPUT_MAX_PENDING)
+
+    async def submit(self, fn: Callable[..., None], *args):
+        await self.slots.acquire()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        future.add_done_callback(self.done)
+
+    def done(self, future: asyncio.Future):
+        self.slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            traceback.print_exception(future.exception())
+
+
+output_writer = OutputWriter()
+
+
+def write_state(data: bytes):
+    write_atomic(STATE_PATH, brotli.compress(data, quality=5))
+
+
+async def save_state(pending_servers: list[ServerRecord]):
+    """
+    Saves the scoring state so that a restart can pick up where we left off.
+    The state is encoded here, but compressed and written on the output thread.
+    """
+    shuffle_score_history.expire()
+    rtt_history.expire()
+    state = {
+        "saved": utcnow().timestamp(),
+        "player_counts": player_count_history.to_state(),
+        "shuffle_scores": dict(shuffle_score_history.items()),
+        "rtts": {steamid: list(samples) for steamid, samples in rtt_history.items()},
+        "pending_servers": [server.to_state() for server in pending_servers],
+    }
+    await output_writer.submit(write_state, orjson.dumps(state))
+
+
+def load_state() -> tuple[list[ServerRecord], float]:
+    """
+    Loads the scoring state saved by save_state.
+    :return: The pending servers and the age of the state in seconds
+    """
+    if not STATE_PATH.exists():
+        return [], math.inf
+    try:
+        state = orjson.loads(brotli.decompress(STATE_PATH.read_bytes()))
+        age = utcnow().timestamp() - state["saved"]
+        if not player_count_history.load_state(state["player_counts"]):
+            print("Saved player counts don't match the history layout, skipping")
+        if age < shuffle_score_history.ttl:
+            shuffle_score_history.update(state["shuffle_scores"])
+        if age < rtt_history.ttl:
+            for steamid, samples in state["rtts"].items():
+                rtt_history[steamid] = array.array("H", samples)
+        pending_servers = [
+            ServerRecord.from_state(server) for server in state["pending_servers"]
+        ]
+    except Exception:
+        traceback.print_exc()
+        return [], math.inf
+    return pending_servers, age
+
+
+PARTITIONS_PATH = Path("servers")
+
+
+def encode_partitions(
+    ranking: ServerRanking, partition_paths: set[Path]
+) -> dict[Path, bytes]:
+    """
+    Encodes compact slices of the ranking by continent and by gamemode tag.
+    """
+    partitions: dict[Path, list[ServerRecord]] = {}
+    for continent in ALL_CONTINENTS:
+        partitions[PARTITIONS_PATH / "continent" / f"{continent}.json"] = []
+    for server in ranking:
+        if server.removal is None and server.continent:
+            path = PARTITIONS_PATH / "continent" / f"{server.continent}.json"
+            partitions.setdefault(path, []).append(server)
+    for tag in ANY_VALID_TAGS:
+        partitions[PARTITIONS_PATH / "gamemode" / f"{tag}.json"] = [
+            server for server in ranking.ranked(tag) if server.removal is None
+        ]
+    # empty out partitions that lost all their servers rather than leave them stale
+    for path in partition_paths:
+        partitions.setdefault(path, [])
+    partition_paths.update(partitions)
+    return {
+        path: orjson.dumps(servers, default=ServerRecord.to_json)
+        for path, servers in partitions.items()
+    }
+
+
+SNAPSHOT_TOP_COUNT = 100
+SNAPSHOT_BROTLI_QUALITY = 5
+SNAPSHOT_GZIP_LEVEL = 6
+
+
+class Snapshot(NamedTuple):
+    """
+    A serialized snapshot with its precompressed encodings.
+    """
+
+    etag: str
+    identity: bytes
+    br: bytes
+    gzip: bytes
+
+
+# snapshots served over HTTP, keyed by their path without the extension
+snapshots: dict[str, Snapshot] = {}
+
+
+def update_snapshot(name: str, data: bytes):
+    # the same content in any encoding, so a weak tag
+    etag = f'W/"{hashlib.blake2b(data, digest_size=16).hexdigest()}"'
+    snapshot = snapshots.get(name)
+    if snapshot is not None and snapshot.etag == etag:
+        return
+    snapshots[name] = Snapshot(
+        etag,
+        data,
+        brotli.compress(data, quality=SNAPSHOT_BROTLI_QUALITY),
+        gzip.compress(data, compresslevel=SNAPSHOT_GZIP_LEVEL),
+    )
+
+
+def encode_snapshots(
+    servers_data: bytes,
+    ranking: ServerRanking,
+    partitions: dict[Path, bytes],
+) -> dict[str, bytes]:
+    """
+    Encodes the HTTP snapshots, reusing the encodings of the files they mirror.
+    """
+    encoded = {SERVERS_PATH.stem: servers_data}
+    for tag in [None, *ANY_VALID_TAGS]:
+        top = [
+            server
+            for server in ranking.top(SNAPSHOT_TOP_COUNT, tag)
+            if server.removal is None
+        ]
+        name = "top" if tag is None else f"gamemode/{tag}/top"
+        encoded[(PARTITIONS_PATH / name).as_posix()] = orjson.dumps(
+            top, default=ServerRecord.to_json
+        )
+    for path, data in partitions.items():
+        encoded[path.with_suffix("").as_posix()] = data
+    return encoded
+
+
+def update_snapshots(encoded: dict[str, bytes]):
+    """
+    Refreshes the HTTP snapshots, recompressing only the ones that changed.
+    This runs on the output thread, where compressing doesn't hold up requests.
+    """
+    for name, data in encoded.items():
+        update_snapshot(name, data)
+
+
+def accepted_encodings(header: str) -> set[str]:
+    encodings = set()
+    for part in header.split(","):
+        encoding, *params = part.split(";")
+        weight = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0
+        if weight > 0:
+            encodings.add(encoding.strip().lower())
+    return encodings
+
+
+async def handle_snapshot(request: web.Request) -> web.Response:
+    snapshot = snapshots.get(request.match_info["name"])
+    if snapshot is None:
+        raise web.HTTPNotFound()
+    headers = {
+        "ETag": snapshot.etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "no-cache",
+    }
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        # weak comparison, as the tag is shared by all encodings
+        tags = set(tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+        if "*" in tags or snapshot.etag.removeprefix("W/") in tags:
+            return web.Response(status=304, headers=headers)
+    encodings = accepted_encodings(request.headers.get("Accept-Encoding", ""))
+    body = snapshot.identity
+    if "br" in encodings:
+        body = snapshot.br
+        headers["Content-Encoding"] = "br"
+    elif "gzip" in encodings:
+        body = snapshot.gzip
+        headers["Content-Encoding"] = "gzip"
+    return web.Response(body=body, content_type="application/json", headers=headers)
+
+
+async def start_http_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/{name:.+}.json", handle_snapshot)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, HTTP_HOST, int(HTTP_PORT))
+    await site.start()
+    print(f"Serving snapshots on {HTTP_HOST}:{HTTP_PORT}")
+    return runner
+
+
+PUBLISH_RETRY_BASE = 1
+PUBLISH_RETRY_MAX = 30
+
+
+async def publish_servers(comfig_session: aiohttp.ClientSession, data: bytes):
+    async with comfig_session.post(
+        "/api/quickplay/update",
+        headers={
+            "Authorization": f"Bearer {COMFIG_API_KEY}",
+            "Content-Type": "application/json",
+        },
+        data=data,
+    ) as api_resp:
+        print(await api_resp.text())
+        api_resp.raise_for_status()
+
+
+class ServerPublisher:
+    """
+    Publishes server lists to the comfig API from a background task.
+    Only the latest list is kept, so a slow API never holds up a cycle.
+    """
+
+    def __init__(self, comfig_session: aiohttp.ClientSession):
+        self.comfig_session = comfig_session
+        # (payload, until, monotonic time it was submitted)
+        self.pending: tuple[bytes, float, float] | None = None
+        self.wake = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.published = 0
+        self.superseded = 0
+        self.expired = 0
+        self.failures = 0
+        # seconds between submitting a list and the API accepting it
+        self.lag = 0.0
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def submit(self, servers_data: bytes, until: float):
+        # the server list is already encoded, so only the envelope is added around it
+        data = b'{"servers":%b,"until":%b}' % (servers_data, orjson.dumps(until * 1000))
+        if self.pending is not None:
+            self.superseded += 1
+        self.pending = (data, until, time.monotonic())
+        self.wake.set()
+
+    async def run(self):
+        attempt = 0
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            while self.pending is not None:
+                data, until, submitted = self.pending
+                self.pending = None
+                if until <= utcnow().timestamp():
+                    # the API would already consider it stale
+                    self.expired += 1
+                    attempt = 0
+                    continue
+                try:
+                    await publish_servers(self.comfig_session, data)
+                except Exception:
+                    traceback.print_exc()
+                    self.failures += 1
+                    # retry unless a newer list arrived in the meantime
+                    if self.pending is None:
+                        self.pending = (data, until, submitted)
+                    else:
+                        self.superseded += 1
+                    delay = min(PUBLISH_RETRY_MAX, PUBLISH_RETRY_BASE * 2**attempt)
+                    attempt += 1
+                    await asyncio.sleep(delay * random.uniform(0.5, 1))
+                    continue
+                attempt = 0
+                self.published += 1
+                self.lag = time.monotonic() - submitted
+                print(
+                    f"Published after {self.lag:.2f}s"
+                    f" ({self.superseded} superseded, {self.expired} expired)"
+                )
+
+
 def lerp(in_a, in_b, out_a, out_b, x):
     return out_a + ((out_b - out_a) * (x - in_a)) / (in_b - in_a)
 
 
-def get_score(server):
-    return server["score"]
+def get_score(server: ServerRecord):
+    return server.score
 
 
 def to_nearest_even(num: float):
@@ -846,8 +1819,263 @@ async def is_valid_image_url(url: str, session: aiohttp.ClientSession) -> bool:
         return False
 
 
+# requests per second and burst shared by every Steam API endpoint
+STEAM_RATE = 20
+STEAM_BURST = 40
+# endpoint -> (requests per second, burst, concurrent requests)
+STEAM_ENDPOINT_LIMITS = {
+    "/IGameServersService/GetServerList/v1/": (1, 3, 2),
+}
+STEAM_DEFAULT_ENDPOINT_LIMIT = (5, 10, 4)
+
+
+class TokenBucket:
+    """
+    Refills at rate tokens per second, holding at most burst tokens.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class EndpointLimit:
+    """
+    The token bucket, concurrency cap and queue wait metrics of an endpoint.
+    """
+
+    __slots__ = ("bucket", "semaphore", "requests", "wait_total", "wait_max")
+
+    def __init__(self, rate: float, burst: float, concurrency: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.requests = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class SteamRateLimiter:
+    """
+    Rate limits every request on the Steam API session, as a client middleware.
+    """
+
+    def __init__(self):
+        self.shared = TokenBucket(STEAM_RATE, STEAM_BURST)
+        self.endpoints: dict[str, EndpointLimit] = {}
+
+    def get_limit(self, path: str) -> EndpointLimit:
+        limit = self.endpoints.get(path)
+        if limit is None:
+            limit = EndpointLimit(
+                *STEAM_ENDPOINT_LIMITS.get(path, STEAM_DEFAULT_ENDPOINT_LIMIT)
+            )
+            self.endpoints[path] = limit
+        return limit
+
+    async def acquire(self, path: str) -> EndpointLimit:
+        limit = self.get_limit(path)
+        start = time.monotonic()
+        await limit.semaphore.acquire()
+        try:
+            while True:
+                now = time.monotonic()
+                delay = max(self.shared.wait_time(now), limit.bucket.wait_time(now))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        except BaseException:
+            limit.semaphore.release()
+            raise
+        self.shared.tokens -= 1
+        limit.bucket.tokens -= 1
+        wait = time.monotonic() - start
+        limit.requests += 1
+        limit.wait_total += wait
+        limit.wait_max = max(limit.wait_max, wait)
+        return limit
+
+    async def middleware(
+        self, request: aiohttp.ClientRequest, handler: aiohttp.ClientHandlerType
+    ) -> aiohttp.ClientResponse:
+        limit = await self.acquire(request.url.path)
+        try:
+            return await handler(request)
+        finally:
+            limit.semaphore.release()
+
+    def report_waits(self):
+        """
+        Prints the queue wait of each endpoint since the last report.
+        """
+        for path, limit in self.endpoints.items():
+            if not limit.requests:
+                continue
+            print(
+                f"{path}: {limit.requests} requests, queued"
+                f" {limit.wait_total / limit.requests:.3f}s avg,"
+                f" {limit.wait_max:.3f}s max"
+            )
+            limit.requests = 0
+            limit.wait_total = 0.0
+            limit.wait_max = 0.0
+
+
+steam_rate_limiter = SteamRateLimiter()
+
+
+STEAM_LATENCY_SAMPLES = 64
+STEAM_HEDGE_PERCENTILE = 0.95
+STEAM_HEDGE_MIN_SAMPLES = 8
+STEAM_HEDGE_MIN_DELAY = 1.0
+# upper bounds of the latency histogram buckets, in seconds
+STEAM_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf)
+STEAM_LATENCY_LABELS = [f"<={bound}s" for bound in STEAM_LATENCY_BUCKETS[:-1]] + [
+    f">{STEAM_LATENCY_BUCKETS[-2]}s"
+]
+STEAM_CACHE_MAX_AGE = 5 * 60
+SERVER_LIST_PATH = "/IGameServersService/GetServerList/v1/"
+
+
+def parse_steam_response(body: bytes):
+    """
+    Parses a Steam API response straight from bytes.
+    Server names can carry invalid UTF-8, which is only repaired if parsing fails.
+    """
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return orjson.loads(body.decode("utf-8", errors="replace"))
+
+
+class EndpointStats:
+    """
+    Latency history of a Steam API endpoint.
+    """
+
+    __slots__ = ("samples", "histogram", "hedged", "hedge_wins", "failures")
+
+    def __init__(self):
+        # the most recent latencies, for picking the hedge delay
+        self.samples = array.array("f")
+        self.histogram = [0] * len(STEAM_LATENCY_BUCKETS)
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failures = 0
+
+    def record(self, latency: float):
+        self.samples.append(latency)
+        if len(self.samples) > STEAM_LATENCY_SAMPLES:
+            del self.samples[0]
+        self.histogram[bisect_left(STEAM_LATENCY_BUCKETS, latency)] += 1
+
+    def hedge_delay(self) -> float | None:
+        if len(self.samples) < STEAM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        idx = min(int(len(ordered) * STEAM_HEDGE_PERCENTILE), len(ordered) - 1)
+        return max(ordered[idx], STEAM_HEDGE_MIN_DELAY)
+
+
+class SteamRequests:
+    """
+    Steam API requests that are hedged once they run past a high latency percentile.
+    The last good response of each endpoint is kept as a fallback.
+    """
+
+    def __init__(self, api_session: aiohttp.ClientSession):
+        self.api_session = api_session
+        self.stats: dict[str, EndpointStats] = defaultdict(EndpointStats)
+        # endpoint -> (body, monotonic time it arrived)
+        self.responses: dict[str, tuple[bytes, float]] = {}
+
+    async def fetch(self, path: str, params: dict | None) -> bytes:
+        async with self.api_session.get(path, params=params) as resp:
+            return await resp.read()
+
+    async def get(self, path: str, params: dict | None = None) -> bytes:
+        stats = self.stats[path]
+        delay = stats.hedge_delay()
+        start = time.monotonic()
+        first = asyncio.create_task(self.fetch(path, params))
+        pending = {first}
+        if delay is not None:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                print(f"Hedging {path} after {delay:.2f}s")
+                stats.hedged += 1
+                pending.add(asyncio.create_task(self.fetch(path, params)))
+        error = None
+        try:
+            # the first good response wins, and the other request is cancelled
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is not first:
+                        stats.hedge_wins += 1
+                    now = time.monotonic()
+                    stats.record(now - start)
+                    body = task.result()
+                    self.responses[path] = (body, now)
+                    return body
+        finally:
+            for task in pending:
+                task.cancel()
+        stats.failures += 1
+        raise error
+
+    def report(self):
+        """
+        Prints the latency histogram, hedges and failures of each endpoint since the
+        last report.
+        """
+        for path, stats in self.stats.items():
+            requests = sum(stats.histogram) + stats.failures
+            if not requests:
+                continue
+            latencies = ", ".join(
+                f"{label}: {count}"
+                for label, count in zip(STEAM_LATENCY_LABELS, stats.histogram)
+                if count
+            )
+            print(
+                f"{path}: {requests} requests, latency {latencies or 'none'},"
+                f" hedged {stats.hedged} (won {stats.hedge_wins}),"
+                f" failed {stats.failures}"
+            )
+            stats.histogram = [0] * len(STEAM_LATENCY_BUCKETS)
+            stats.hedged = 0
+            stats.hedge_wins = 0
+            stats.failures = 0
+
+    def cached(self, path: str, max_age: float) -> tuple[bytes, float] | None:
+        """
+        Gets the last good response of an endpoint and its age, if recent enough.
+        """
+        response = self.responses.get(path)
+        if response is None:
+            return None
+        body, received = response
+        age = time.monotonic() - received
+        if age > max_age:
+            return None
+        return body, age
+
+
 async def query_runner(
-    geoasn: geoip2.database.Reader,
     geoip: geoip2.database.Reader,
     api_session: aiohttp.ClientSession,
     cdn_session: aiohttp.ClientSession,
@@ -863,18 +2091,32 @@ async def query_runner(
         "limit": QUERY_LIMIT,
         "filter": QUERY_FILTER,
     }
+    publisher = ServerPublisher(comfig_session)
+    publisher.start()
+    steam_requests = SteamRequests(api_session)
+    # warm start from the saved state, publishing its snapshot while the first cycle runs
+    pending_servers, state_age = load_state()
+    if not DEBUG and state_age < STATE_MAX_PUBLISH_AGE and SERVERS_PATH.exists():
+        try:
+            until = (
+                utcnow()
+                + datetime.timedelta(seconds=QUERY_INTERVAL + QUERY_INTERVAL_VARIANCE)
+            ).timestamp()
+            publisher.submit(SERVERS_PATH.read_bytes(), until)
+        except Exception:
+            traceback.print_exc()
+    next_state_save = time.monotonic() + STATE_SAVE_INTERVAL
     # data
     gamemodes: dict[str, set[str]] = {}
     map_name_to_defidx: dict[str, int] = {}
     map_defidx_to_name: dict[int, str] = {}
     map_gamemode: dict[str, str] = dict(BASE_GAME_MAPS)
     holiday_map_gamemode: dict[int, dict[str, str]] = defaultdict(dict)
+    map_info: dict[str, MapInfo] = {}
+    partition_paths: set[Path] = set()
     # tables
-    banned_ips = set(get_value("ips", default=[], table=ban_table))
-    banned_ids = set(get_value("ids", default=[], table=ban_table))
-    banned_name_search = get_value("names", default=[], table=ban_table)
-    banned_tags = set(get_value("tags", default=[], table=ban_table))
-    anycast_ips = set(get_value("ips", default=[], table=anycast_table))
+    server_rules_mtime = get_db_mtime()
+    server_rules = load_server_rules()
     # get information about the querier
     my_ip = "127.0.0.1"
     async with aiohttp.ClientSession("https://api.ipify.org") as ip_session:
@@ -889,31 +2131,27 @@ async def query_runner(
 
     # initial values
     LAST_MONTH = 0
-    pending_servers = []
     updated_servers = False
 
     last_thumbnails_update = utcnow() - datetime.timedelta(hours=24)
 
-    # extra rules table
-    ip_to_rules_group = {}
-    id_to_rules_group = {}
-    rules_groups = []
-    group_idx = 0
-    for rule_group in get_value("rule_groups", default=[], table=extras_table):
-        ips = rule_group.get("ips", [])
-        ids = rule_group.get("ids", [])
-        for ip in ips:
-            ip_to_rules_group[ip] = group_idx
-        for steamid in ids:
-            id_to_rules_group[steamid] = group_idx
-        rules_groups.append(rule_group.get("rules", {}))
-        group_idx += 1
-
     # main loop
     while True:
+        # pick up edits to the tables without a restart
+        db_mtime = get_db_mtime()
+        if db_mtime != server_rules_mtime:
+            try:
+                reopen_db()
+                server_rules = load_server_rules()
+                server_rules_mtime = db_mtime
+                server_class_cache.clear()
+                print("Reloaded server rules")
+            except Exception:
+                # keep the previous rules if the file is mid-write
+                traceback.print_exc()
         next_query_interval = QUERY_INTERVAL + chaos(QUERY_INTERVAL_VARIANCE)
         items_game, updated, server_version = await req_items_game(
-            api_session, cdn_session
+            steam_requests, cdn_session
         )
         now = utcnow()
         month = now.month
@@ -925,6 +2163,7 @@ async def query_runner(
             if items_game:
                 if updated:
                     update_thumbnails = True
+                    server_class_cache.clear()
                     gamemodes = {}
                     holiday_map_gamemode = defaultdict(dict)
 
@@ -978,6 +2217,10 @@ async def query_runner(
                         else:
                             gamemodes[gamemode] = gamemode_maps
                     map_gamemode = dict(sorted(map_gamemode.items()))
+                    map_info = {
+                        name: classify_map(name, map_gamemode, holiday_map_gamemode)
+                        for name in map_gamemode.keys()
+                    }
 
                     map_name_to_defidx = {}
                     map_defidx_to_name = {}
@@ -1072,14 +2315,17 @@ async def query_runner(
 
                 # if we updated any map thumbnails, cache them in the file
                 if updated_thumbnails:
-                    with open(MAP_THUMBNAILS_PATH, "wb") as fp:
-                        fp.write(
-                            orjson.dumps(MAP_THUMBNAILS, option=orjson.OPT_INDENT_2)
-                        )
-                    with open(MAP_OVERVIEWS_PATH, "wb") as fp:
-                        fp.write(
-                            orjson.dumps(MAP_OVERVIEWS, option=orjson.OPT_INDENT_2)
-                        )
+                    await output_writer.submit(
+                        write_files,
+                        {
+                            MAP_THUMBNAILS_PATH: orjson.dumps(
+                                MAP_THUMBNAILS, option=orjson.OPT_INDENT_2
+                            ),
+                            MAP_OVERVIEWS_PATH: orjson.dumps(
+                                MAP_OVERVIEWS, option=orjson.OPT_INDENT_2
+                            ),
+                        },
+                    )
 
                 # if we updated any schema data, update it in the database for web app reference
                 if updated or updated_thumbnails:
@@ -1108,60 +2354,51 @@ async def query_runner(
                 updated_thumbnails = False
 
                 # get server list from Steam API
+                server_list = None
                 try:
-                    async with api_session.get(
-                        "/IGameServersService/GetServerList/v1/",
-                        params=server_params,
-                    ) as resp:
-                        body = await resp.read()
-                        body = body.decode("utf-8", errors="replace")
-                        body = orjson.loads(body)
-                        pending_servers = body["response"]["servers"]
-                        updated_servers = True
+                    server_list = await steam_requests.get(
+                        SERVER_LIST_PATH, params=server_params
+                    )
                 except:
                     traceback.print_exc()
+                    # with nothing left to re-probe, fall back to the last good list
+                    if not pending_servers:
+                        cached = steam_requests.cached(
+                            SERVER_LIST_PATH, STEAM_CACHE_MAX_AGE
+                        )
+                        if cached is not None:
+                            server_list, age = cached
+                            print(f"Using the server list from {age:.0f}s ago")
+                if server_list is not None:
+                    try:
+                        body = parse_steam_response(server_list)
+                        pending_servers = [
+                            ServerRecord.from_steam(server)
+                            for server in body["response"]["servers"]
+                        ]
+                        updated_servers = True
+                    except:
+                        traceback.print_exc()
 
                 async def calc_server(server):
-                    addr = server["addr"]
+                    addr = server.addr
                     # skip servers with SDR
                     if addr.startswith("169.254"):
                         if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {
-                                "score": -999,
-                                "removal": "sdr",
-                                "addr": addr,
-                                "steamid": server["steamid"],
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": server.get("map"),
-                                "gametype": server.get("gametype", "")
-                                .lower()
-                                .split(","),
-                            }
+                            return server.rejected(
+                                "sdr", server.gametype.lower().split(",")
+                            )
                         else:
                             return None
                     quickplay_bonus = 6
                     # check for steam ID
-                    steamid = server["steamid"]
+                    steamid = server.steamid
                     if steamid[0] == "9":
                         if False:
                             if DEBUG and not DEBUG_SKIP_SERVERS:
-                                return {
-                                    "score": -999,
-                                    "removal": "nosteam",
-                                    "addr": addr,
-                                    "steamid": steamid,
-                                    "name": server["name"],
-                                    "players": server["players"],
-                                    "max_players": server["max_players"],
-                                    "bots": server["bots"],
-                                    "map": server.get("map"),
-                                    "gametype": server.get("gametype", "")
-                                    .lower()
-                                    .split(","),
-                                }
+                                return server.rejected(
+                                    "nosteam", server.gametype.lower().split(",")
+                                )
                             else:
                                 return None
                         else:
@@ -1171,235 +2408,254 @@ async def query_runner(
                         ip, port = addr.split(":")
                         if True:
                             try:
-                                server_query = await a2s.ainfo((ip, port))
+                                server_query = await a2s.ainfo(
+                                    (ip, port), timeout=get_a2s_timeout(steamid)
+                                )
                             except:
+                                forget_rtt(steamid)
                                 return None
-                            server["appid"] = server_query.app_id
-                            server["gamedir"] = server_query.folder
-                            server["product"] = server_query.folder
-                            server["players"] = (
+                            record_rtt(steamid, server_query.ping)
+                            server.appid = server_query.app_id
+                            server.gamedir = server_query.folder
+                            server.product = server_query.folder
+                            server.players = (
                                 server_query.player_count - server_query.bot_count
                             )
-                            server["bots"] = server_query.bot_count
-                            server["map"] = server_query.map_name
-                            server["gametype"] = server_query.keywords
-                            server["version"] = server_query.version
+                            server.bots = server_query.bot_count
+                            server.map = server_query.map_name
+                            server.gametype = server_query.keywords
+                            server.version = server_query.version
                         else:
-                            server["appid"] = 440
-                            server["gamedir"] = "tf"
-                            server["product"] = "tf"
-                            server["version"] = server_version
-                            server["gametype"] = ",".join(server["gametype"])
+                            server.appid = 440
+                            server.gamedir = "tf"
+                            server.product = "tf"
+                            server.version = server_version
+                            server.gametype = ",".join(server.gametype)
 
                     # not tf, leave
-                    if server["appid"] != APP_ID:
+                    if server.appid != APP_ID:
                         if DEBUG and not DEBUG_SKIP_SERVERS and False:
                             return {"score": -999, "removal": "noappid"}
                         else:
                             return None
-                    if server["gamedir"] != APP_NAME:
+                    if server.gamedir != APP_NAME:
                         if DEBUG and not DEBUG_SKIP_SERVERS and False:
                             return {"score": -999, "removal": "nogamedir"}
                         else:
                             return None
-                    if server["product"] != APP_NAME:
+                    if server.product != APP_NAME:
                         if DEBUG and not DEBUG_SKIP_SERVERS and False:
                             return {"score": -999, "removal": "noprod"}
                         else:
                             return None
                     # check max players
-                    max_players = server["max_players"]
+                    max_players = server.max_players
                     if max_players < MIN_PLAYER_CAP:
                         # not enough max_players
                         if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {
-                                "score": -999,
-                                "removal": "<18",
-                                "addr": addr,
-                                "steamid": steamid,
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": server.get("map"),
-                                "gametype": server.get("gametype", "")
-                                .lower()
-                                .split(","),
-                            }
+                            return server.rejected(
+                                "<18", server.gametype.lower().split(",")
+                            )
                         else:
                             return None
                     if max_players > MAX_PLAYER_CAP:
                         # too much max_players
                         if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {"score": -999, "removal": ">101"}
+                            return server.rejected(
+                                ">101", server.gametype.lower().split(",")
+                            )
                         else:
                             return None
-                    num_players = server["players"]
+                    num_players = server.players
                     if num_players >= max_players:
                         # lying about players
                         if DEBUG and not DEBUG_SKIP_SERVERS and False:
                             return {"score": -999, "removal": "playercaplie"}
                         else:
                             return None
-                    # check if out of date
-                    if int(server["version"]) < server_version:
+                    map = server.map
+                    ip, port = addr.split(":")
+                    # only reclassify the server if its static inputs changed
+                    fingerprint = (
+                        steamid,
+                        server.name,
+                        map,
+                        server.gametype,
+                        max_players,
+                        server.version,
+                        server_version,
+                    )
+                    cached_class = server_class_cache.get(addr)
+                    if cached_class is not None and cached_class[0] == fingerprint:
+                        server_class = cached_class[1]
+                    else:
+                        server_class = classify_server(server, steamid, ip, map)
+                        server_class_cache[addr] = (fingerprint, server_class)
+                    if server_class.removal is not None:
+                        if (
+                            DEBUG
+                            and not DEBUG_SKIP_SERVERS
+                            and server_class.removal not in SILENT_REMOVALS
+                        ):
+                            return server.rejected(
+                                server_class.removal, server_class.gametype
+                            )
+                        else:
+                            return None
+                    gametype = server_class.gametype
+                    name = server_class.name
+                    quickplay_bonus += server_class.bonus
+                    bots = server.bots
+                    rep = get_value(steamid, table=rep_table)
+                    if rep is None:
+                        rep = 0
+                    score = rep + quickplay_bonus
+                    score += score_server(num_players, max_players)
+                    if updated_servers:
+                        try:
+                            server_query = await a2s.ainfo(
+                                (ip, port), timeout=get_a2s_timeout(steamid)
+                            )
+                        except:
+                            forget_rtt(steamid)
+                            if DEBUG and not DEBUG_SKIP_SERVERS:
+                                return server.rejected("timeout", gametype)
+                            else:
+                                return None
+                        record_rtt(steamid, server_query.ping)
+                    if server_query.password_protected:
                         if DEBUG and not DEBUG_SKIP_SERVERS and False:
-                            return {"score": -999, "removal": "outofdate"}
+                            return {"score": -999, "removal": "pass"}
                         else:
                             return None
-                    # check if it's a casual map
-                    map = server.get("map")
-                    if not map:
+                    if server_query.app_id != APP_ID:
                         return None
-                    map_split = map.split("_")
-                    prefix = map_split[0]
-                    forced_custom_map = prefix in ALLOWED_CUSTOM_MAP_PREFIXES
-                    if map not in map_gamemode and not forced_custom_map:
-                        if DEBUG and not DEBUG_SKIP_SERVERS:
-                            if prefix == "arena":
-                                return {
-                                    "score": -999,
-                                    "removal": "arenamap",
-                                    "addr": addr,
-                                    "steamid": steamid,
-                                    "name": server["name"],
-                                    "players": server["players"],
-                                    "max_players": server["max_players"],
-                                    "bots": server["bots"],
-                                    "map": map,
-                                    "gametype": server.get("gametype", "")
-                                    .lower()
-                                    .split(","),
-                                }
-                            holiday = False
-                            for map_lookup in holiday_map_gamemode.values():
-                                if map in map_lookup:
-                                    holiday = True
-                                    break
-                            if holiday:
-                                return {
-                                    "score": -999,
-                                    "removal": "holidaymap",
-                                    "addr": addr,
-                                    "steamid": steamid,
-                                    "name": server["name"],
-                                    "players": server["players"],
-                                    "max_players": server["max_players"],
-                                    "bots": server["bots"],
-                                    "map": map,
-                                    "gametype": server.get("gametype", "")
-                                    .lower()
-                                    .split(","),
-                                }
-                            if prefix in DEFAULT_MAP_PREFIXES and not map.startswith(
-                                "cp_orange"
-                            ):
-                                if len(map_split) > 2:
-                                    unversion_name = "_".join(map_split[:-1])
-                                    if unversion_name in COMMUNITY_MAPS_UNVERSIONED:
-                                        return {
-                                            "score": -999,
-                                            "removal": "versionmapdiff",
-                                            "addr": addr,
-                                            "steamid": steamid,
-                                            "name": server["name"],
-                                            "players": server["players"],
-                                            "max_players": server["max_players"],
-                                            "bots": server["bots"],
-                                            "map": map,
-                                            "gametype": server.get("gametype", "")
-                                            .lower()
-                                            .split(","),
-                                        }
-
+                    if server_query.game_id != APP_ID:
+                        return None
+                    if server_query.folder != APP_NAME:
+                        return None
+                    if server_query.game != APP_FULL_NAME:
+                        if False:
+                            if DEBUG and not DEBUG_SKIP_SERVERS:
                                 return {
                                     "score": -999,
-                                    "removal": "custommap",
-                                    "addr": addr,
-                                    "steamid": steamid,
-                                    "name": server["name"],
-                                    "players": server["players"],
-                                    "max_players": server["max_players"],
-                                    "bots": server["bots"],
-                                    "map": map,
-                                    "gametype": server.get("gametype", "")
-                                    .lower()
-                                    .split(","),
+                                    "removal": "incorrectgame",
+                                    "name": name,
+                                    "game": server_query.game,
+                                    "players": server.players,
                                 }
-                            return {
-                                "score": -999,
-                                "removal": "badmap",
-                                "addr": addr,
-                                "steamid": steamid,
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": map,
-                                "gametype": server.get("gametype", "")
-                                .lower()
-                                .split(","),
-                            }
+                            else:
+                                return None
                         else:
+                            score -= 0.1
+                    # the lowest player count in the past hour
+                    history_row = player_count_history.get_row(steamid)
+                    prev_player_count = PLAYER_HISTORY_EMPTY
+                    if history_row >= 0:
+                        prev_player_count = lowest_player_counts[history_row]
+                    player_count_history.record(steamid, num_players)
+                    if (
+                        prev_player_count < PLAYER_TREND_COUNT_LOW_POINT_LIMIT
+                        and num_players < PLAYER_TREND_COUNT_MAX
+                    ):
+                        player_increase = num_players - prev_player_count
+                        if player_increase > 0:
+                            if num_players >= PLAYER_TREND_COUNT_LOW_POINT_LIMIT:
+                                score += PLAYER_TREND_MAX
+                            else:
+                                score += lerp(
+                                    0,
+                                    PLAYER_TREND_COUNT_LOW_POINT_LIMIT,
+                                    PLAYER_TREND_MIN,
+                                    PLAYER_TREND_MAX,
+                                    num_players,
+                                )
+                    # shift the scores around a little bit so we get some variance in sorting
+                    shuffle_score = shuffle_score_history.get(steamid, None)
+                    if num_players == 0:
+                        if shuffle_score is None:
+                            shuffle_score = shuffle(score, pct=0.0005) - score
+                            shuffle_score_history[steamid] = shuffle_score
+                        score += shuffle_score
+                    elif shuffle_score is not None:
+                        del shuffle_score_history[steamid]
+                    # calculate ping score
+                    ping = server_query.ping * 1000
+                    geo_override = get_value(ip, table=geo_table)
+                    if geo_override:
+                        country = geo_override["country"]
+                        continent = geo_override["continent"]
+                        lon = geo_override["lon"]
+                        lat = geo_override["lat"]
+                    else:
+                        try:
+                            city = geoip.city(ip)
+                        except:
+                            if DEBUG:
+                                traceback.print_exc()
                             return None
+                        country = city.country.iso_code
+                        continent = city.continent.code
+                        lon = city.location.longitude
+                        lat = city.location.latitude
+                    # the reported region is often wrong, so partitions go by location
+                    server.continent = continent
+                    point = (lat, lon)
+                    if server_class.anycast:
+                        score -= 0.1
+                    dist = geopy.distance.distance(my_point, point).km
+                    # found through gradient descent
+                    ideal = dist / 65.5
+                    overhead = max(ping - ideal - 1, 1)
+                    if server.name.startswith("\u0001"):
+                        score -= 0.1
+                    server.name = name
+                    server.gametype = gametype
+                    server.score = score
+                    server.point = (lon, lat)
+                    server.ping = overhead
+                    return server
+
+                def classify_server(server, steamid: str, ip: str, map: str | None):
+                    raw_gametype = server.gametype.lower().split(",")
+                    # check if out of date
+                    if int(server.version) < server_version:
+                        return ServerClass("outofdate", raw_gametype)
+                    # check if it's a casual map
+                    if not map:
+                        return ServerClass("nomap", raw_gametype)
+                    map_details = map_info.get(map)
+                    if map_details is None:
+                        # not in the schema, classify it once and keep it until the next update
+                        map_details = classify_map(
+                            map, map_gamemode, holiday_map_gamemode
+                        )
+                        map_info[map] = map_details
+                    if map_details.removal is not None:
+                        return ServerClass(map_details.removal, raw_gametype)
                     # check for ban
-                    if server["steamid"] in banned_ids:
-                        if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {
-                                "score": -999,
-                                "removal": "steamban",
-                                "addr": addr,
-                                "steamid": steamid,
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": map,
-                                "gametype": server.get("gametype", "")
-                                .lower()
-                                .split(","),
-                            }
-                        else:
-                            return None
-                    ip, port = addr.split(":")
-                    if ip in banned_ips:
-                        if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {
-                                "score": -999,
-                                "removal": "ipban",
-                                "addr": addr,
-                                "steamid": steamid,
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": map,
-                                "gametype": server.get("gametype", "")
-                                .lower()
-                                .split(","),
-                            }
-                        else:
-                            return None
+                    if steamid in server_rules.banned_ids:
+                        return ServerClass("steamban", raw_gametype)
+                    network_match = server_rules.networks.lookup(ip)
+                    if network_match.banned:
+                        return ServerClass("ipban", raw_gametype)
 
-                    rules = {}
-                    rules_group = id_to_rules_group.get(steamid, -1)
-                    if rules_group < 0:
-                        rules_group = ip_to_rules_group.get(ip, -1)
-                    if rules_group >= 0:
-                        rules = rules_groups[rules_group]
-                    rule_flags = set(rules.get("flags", []))
+                    rules = server_rules.id_to_rules_group.get(steamid)
+                    if rules is None:
+                        rules = network_match.rules_group or EMPTY_RULE_GROUP
+                    rule_flags = rules.flags
 
-                    quickplay_bonus += rules.get("score_adj", 0)
+                    bonus = rules.score_adj
 
                     # normalize name
-                    name = server["name"]
+                    name = server.name
                     lower_name = name.lower()
                     # check for gametype
-                    gametype = server.get("gametype")
+                    gametype = server.gametype
                     if not gametype:
-                        return None
+                        return ServerClass("notags", raw_gametype)
                     gametype = set(gametype.lower().split(","))
-                    for tag_exc in rules.get("tags_exc", []):
+                    for tag_exc in rules.tags_exc:
                         gametype.discard(tag_exc)
                     if "rtd" not in gametype:
                         if "rtd" in lower_name:
@@ -1428,89 +2684,37 @@ async def query_runner(
                             gametype.add("norespawntime")
                         elif any((x in lower_name for x in FAST_RESPAWN_LIKELY_NAME)):
                             gametype.add("norespawntime")
-                    forced_tags = rules.get("forced_tags")
-                    if forced_tags:
-                        gametype.update(forced_tags)
-                    tag_rules = rules.get("name_to_tags")
-                    if tag_rules:
-                        for pattern, tags in tag_rules.items():
-                            if pattern in lower_name:
-                                for tag in tags:
-                                    if tag.startswith("-"):
-                                        gametype.discard(tag[1:])
-                                    else:
-                                        gametype.add(tag)
+                    gametype.update(rules.forced_tags)
+                    for pattern, tag_edits in rules.name_to_tags:
+                        if pattern in lower_name:
+                            for tag, add in tag_edits:
+                                if add:
+                                    gametype.add(tag)
+                                else:
+                                    gametype.discard(tag)
+                    max_players = server.max_players
                     # is lying about max players?
                     if (
                         max_players > 25
                         and "increased_maxplayers" not in gametype
                         and "ignore_maxplayers_tag" not in rule_flags
                     ):
-                        if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {
-                                "score": -999,
-                                "removal": "-maxplayers",
-                                "addr": addr,
-                                "steamid": steamid,
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": map,
-                                "gametype": list(gametype),
-                            }
-                        else:
-                            return None
+                        return ServerClass("-maxplayers", list(gametype))
                     if (
                         max_players <= 24
                         and "increased_maxplayers" in gametype
                         and "ignore_maxplayers_tag" not in rule_flags
                     ):
-                        if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {
-                                "score": -999,
-                                "removal": "+maxplayers",
-                                "addr": addr,
-                                "steamid": steamid,
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": map,
-                                "gametype": list(gametype),
-                            }
-                        else:
-                            return None
-                    if not forced_custom_map:
+                        return ServerClass("+maxplayers", list(gametype))
+                    if not map_details.forced_custom:
                         # is it any of the gamemodes we want?
                         found_valid_gametype = (
                             len(gametype.intersection(ANY_VALID_TAGS)) > 0
                         )
                         if not found_valid_gametype and "ignore_tags" not in rule_flags:
-                            if DEBUG and not DEBUG_SKIP_SERVERS:
-                                return {
-                                    "score": -999,
-                                    "removal": "nogametype",
-                                    "addr": addr,
-                                    "steamid": steamid,
-                                    "name": server["name"],
-                                    "players": server["players"],
-                                    "max_players": server["max_players"],
-                                    "bots": server["bots"],
-                                    "map": map,
-                                    "gametype": list(gametype),
-                                }
-                            else:
-                                return None
+                            return ServerClass("nogametype", list(gametype))
                     # is it the gamemode we want?
-                    if forced_custom_map:
-                        expected_gamemode = None
-                    else:
-                        expected_gamemode = GAMEMODE_TO_TAG.get(map_gamemode[map])
-                    if not expected_gamemode:
-                        prefix_gamemode = PREFIX_TO_GAMEMODE.get(prefix)
-                        if prefix_gamemode:
-                            expected_gamemode = GAMEMODE_TO_TAG.get(prefix_gamemode)
+                    expected_gamemode = map_details.expected_tag
                     # we let forced arena as an exception to this
                     if (
                         expected_gamemode
@@ -1518,21 +2722,7 @@ async def query_runner(
                         and "arena" not in gametype
                         and "ignore_tags" not in rule_flags
                     ):
-                        if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {
-                                "score": -999,
-                                "removal": "missingexpectedtag",
-                                "addr": addr,
-                                "steamid": steamid,
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": map,
-                                "gametype": list(gametype),
-                            }
-                        else:
-                            return None
+                        return ServerClass("missingexpectedtag", list(gametype))
                     if expected_gamemode:
                         # we checked if we have the tag we expect. now, let's check if we have tags we DON'T expect.
                         # if we have arena, powerups active, or misc active, that's fine
@@ -1548,207 +2738,27 @@ async def query_runner(
                                 continue
                             if tag in expected_tags:
                                 continue
-                            if DEBUG and not DEBUG_SKIP_SERVERS:
-                                return {
-                                    "score": -999,
-                                    "removal": "unexpectedtag",
-                                    "addr": addr,
-                                    "steamid": steamid,
-                                    "name": server["name"],
-                                    "players": server["players"],
-                                    "max_players": server["max_players"],
-                                    "bots": server["bots"],
-                                    "map": map,
-                                    "gametype": list(gametype),
-                                }
-                            else:
-                                return None
+                            return ServerClass("unexpectedtag", list(gametype))
 
-                    beta_expected = map in BETA_MAPS
+                    beta_expected = map_details.beta
                     if (
                         beta_expected
                         and "beta" not in gametype
                         or not beta_expected
                         and "beta" in gametype
                     ):
-                        if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {
-                                "score": -999,
-                                "removal": "nobeta" if beta_expected else "hasbeta",
-                                "addr": addr,
-                                "steamid": steamid,
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": map,
-                                "gametype": list(gametype),
-                            }
-                        else:
-                            return None
+                        return ServerClass(
+                            "nobeta" if beta_expected else "hasbeta", list(gametype)
+                        )
                     # check for tag errors
-                    found_valid_gametype = len(gametype.intersection(banned_tags)) < 1
+                    found_valid_gametype = gametype.isdisjoint(server_rules.banned_tags)
                     if not found_valid_gametype and "ignore_tags" not in rule_flags:
-                        if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {
-                                "score": -999,
-                                "removal": "badgametype",
-                                "addr": addr,
-                                "steamid": steamid,
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": map,
-                                "gametype": list(gametype),
-                            }
-                        else:
-                            return None
+                        return ServerClass("badgametype", list(gametype))
                     # check for name errors
-                    bad_name = False
-                    for invalid in banned_name_search:
-                        if invalid in lower_name:
-                            bad_name = True
-                    if bad_name:
-                        if DEBUG and not DEBUG_SKIP_SERVERS:
-                            return {
-                                "score": -999,
-                                "removal": "badname",
-                                "addr": addr,
-                                "steamid": steamid,
-                                "name": server["name"],
-                                "players": server["players"],
-                                "max_players": server["max_players"],
-                                "bots": server["bots"],
-                                "map": map,
-                                "gametype": list(gametype),
-                            }
-                        else:
-                            return None
-                    bots = server["bots"]
-                    rep = get_value(steamid, table=rep_table)
-                    if rep is None:
-                        rep = 0
-                    score = rep + quickplay_bonus
-                    score += score_server(num_players, max_players)
-                    if updated_servers:
-                        try:
-                            server_query = await a2s.ainfo((ip, port))
-                        except:
-                            if DEBUG and not DEBUG_SKIP_SERVERS:
-                                return {
-                                    "score": -999,
-                                    "removal": "timeout",
-                                    "addr": addr,
-                                    "steamid": steamid,
-                                    "name": server["name"],
-                                    "players": server["players"],
-                                    "max_players": server["max_players"],
-                                    "bots": bots,
-                                    "map": map,
-                                    "gametype": list(gametype),
-                                }
-                            else:
-                                return None
-                    if server_query.password_protected:
-                        if DEBUG and not DEBUG_SKIP_SERVERS and False:
-                            return {"score": -999, "removal": "pass"}
-                        else:
-                            return None
-                    if server_query.app_id != APP_ID:
-                        return None
-                    if server_query.game_id != APP_ID:
-                        return None
-                    if server_query.folder != APP_NAME:
-                        return None
-                    if server_query.game != APP_FULL_NAME:
-                        if False:
-                            if DEBUG and not DEBUG_SKIP_SERVERS:
-                                return {
-                                    "score": -999,
-                                    "removal": "incorrectgame",
-                                    "name": name,
-                                    "game": server_query.game,
-                                    "players": server["players"],
-                                }
-                            else:
-                                return None
-                        else:
-                            score -= 0.1
-                    # the lowest player count in the past hour
-                    prev_player_count = player_count_history.get(steamid, None)
-                    if prev_player_count is not None:
-                        if num_players < prev_player_count:
-                            player_count_history[steamid] = num_players
-                        else:
-                            if (
-                                prev_player_count < PLAYER_TREND_COUNT_LOW_POINT_LIMIT
-                                and num_players < PLAYER_TREND_COUNT_MAX
-                            ):
-                                player_increase = num_players - prev_player_count
-                                if player_increase > 0:
-                                    if (
-                                        num_players
-                                        >= PLAYER_TREND_COUNT_LOW_POINT_LIMIT
-                                    ):
-                                        score += PLAYER_TREND_MAX
-                                    else:
-                                        score += lerp(
-                                            0,
-                                            PLAYER_TREND_COUNT_LOW_POINT_LIMIT,
-                                            PLAYER_TREND_MIN,
-                                            PLAYER_TREND_MAX,
-                                            num_players,
-                                        )
-                    else:
-                        player_count_history[steamid] = num_players
-                    # shift the scores around a little bit so we get some variance in sorting
-                    shuffle_score = shuffle_score_history.get(steamid, None)
-                    if num_players == 0:
-                        if shuffle_score is None:
-                            shuffle_score = shuffle(score, pct=0.0005) - score
-                            shuffle_score_history[steamid] = shuffle_score
-                        score += shuffle_score
-                    elif shuffle_score is not None:
-                        del shuffle_score_history[steamid]
-                    # calculate ping score
-                    ping = server_query.ping * 1000
-                    geo_override = get_value(ip, table=geo_table)
-                    if geo_override:
-                        country = geo_override["country"]
-                        continent = geo_override["continent"]
-                        lon = geo_override["lon"]
-                        lat = geo_override["lat"]
-                    else:
-                        try:
-                            city = geoip.city(ip)
-                        except:
-                            if DEBUG:
-                                traceback.print_exc()
-                            return None
-                        country = city.country.iso_code
-                        continent = city.continent.code
-                        lon = city.location.longitude
-                        lat = city.location.latitude
-                    # TODO: do something with non-matching regions
-                    server_region = server.get("region", 255)
-                    point = (lat, lon)
-                    try:
-                        asn = geoasn.asn(ip)
-                        # aso = asn.autonomous_system_organization
-                        asnn = str(asn.network)
-                        if asnn in anycast_ips:
-                            score -= 0.1
-                    except geoip2.errors.AddressNotFoundError:
-                        if DEBUG:
-                            print(f"{ip} not in ASN database, passing")
-                    dist = geopy.distance.distance(my_point, point).km
-                    # found through gradient descent
-                    ideal = dist / 65.5
-                    overhead = max(ping - ideal - 1, 1)
+                    banned_names = server_rules.banned_names
+                    if banned_names is not None and banned_names.search(lower_name):
+                        return ServerClass("badname", list(gametype))
                     # strip attention seeking characters
-                    if name.startswith("\u0001"):
-                        score -= 0.1
                     name = (
                         name.replace("\u0001", "")
                         .replace("\t", "")
@@ -1757,43 +2767,38 @@ async def query_runner(
                         .decode("unicode_escape")
                         .strip()
                     )
-                    return {
-                        "addr": addr,
-                        "steamid": steamid,
-                        "name": name,
-                        # "region": server_region,
-                        # "continent": continent,
-                        # "country": country,
-                        "players": num_players,
-                        "max_players": max_players,
-                        "bots": bots,
-                        "map": map,
-                        "gametype": list(gametype),
-                        "score": score,
-                        "point": [lon, lat],
-                        "ping": overhead,
-                    }
+                    return ServerClass(
+                        None, list(gametype), name, bonus, network_match.anycast
+                    )
 
+                player_count_history.advance(now.timestamp())
+                lowest_player_counts = player_count_history.lowest()
                 server_infos = await asyncio.gather(
                     *[calc_server(server) for server in pending_servers]
                 )
                 new_servers = [server for server in server_infos if server]
                 new_servers.sort(key=get_score, reverse=True)
+                server_ranking = ServerRanking(new_servers)
                 pending_servers = new_servers
                 updated_servers = False
-                with open("servers.json", "wb") as fp:
-                    fp.write(orjson.dumps(new_servers, option=orjson.OPT_INDENT_2))
+                # encoded once, for the file, the snapshot and the API alike
+                servers_data = orjson.dumps(new_servers, default=ServerRecord.to_json)
+                await output_writer.submit(write_atomic, SERVERS_PATH, servers_data)
+                partitions = encode_partitions(server_ranking, partition_paths)
+                await output_writer.submit(write_files, partitions)
+                if HTTP_PORT:
+                    await output_writer.submit(
+                        update_snapshots,
+                        encode_snapshots(servers_data, server_ranking, partitions),
+                    )
                 if not DEBUG:
                     until = (
                         utcnow() + datetime.timedelta(seconds=next_query_interval + 1)
                     ).timestamp()
-                    async with comfig_session.post(
-                        "/api/quickplay/update",
-                        headers={"Authorization": f"Bearer {COMFIG_API_KEY}"},
-                        json={"servers": new_servers, "until": until * 1000},
-                    ) as api_resp:
-                        print(await api_resp.text())
+                    publisher.submit(servers_data, until)
                 print(len(new_servers))
+                steam_rate_limiter.report_waits()
+                steam_requests.report()
                 if DEBUG and not DEBUG_SKIP_SERVERS:
                     print(
                         len(
@@ -1804,6 +2809,9 @@ async def query_runner(
                             ]
                         )
                     )
+            if time.monotonic() >= next_state_save:
+                next_state_save = time.monotonic() + STATE_SAVE_INTERVAL
+                await save_state(pending_servers)
         except Exception:
             traceback.print_exc()
 
@@ -1834,18 +2842,21 @@ def handle_geoip(geoipDb, edition):
 
 
 def encode_json(obj):
-    return orjson.dumps(obj).decode("utf-8")
+    return orjson.dumps(obj, default=ServerRecord.to_json).decode("utf-8")
 
 
 async def main():
-    geoipDb = Path(f"./GeoIP2-City.mmdb")
-    handle_geoip(geoipDb, "GeoLite2-City")
-    geoAsnDb = Path(f"./GeoIP2-ASN.mmdb")
-    handle_geoip(geoAsnDb, "GeoLite2-ASN")
-    with geoip2.database.Reader(geoAsnDb) as geoasn:
+    http_runner = None
+    if HTTP_PORT:
+        http_runner = await start_http_server()
+    try:
+        geoipDb = Path(f"./GeoIP2-City.mmdb")
+        handle_geoip(geoipDb, "GeoLite2-City")
         with geoip2.database.Reader(geoipDb) as geoip:
             async with aiohttp.ClientSession(
-                base_url="https://api.steampowered.com", raise_for_status=True
+                base_url="https://api.steampowered.com",
+                raise_for_status=True,
+                middlewares=(steam_rate_limiter.middleware,),
             ) as api_session:
                 async with aiohttp.ClientSession(
                     base_url=CDN_BASE_URL, raise_for_status=True
@@ -1858,13 +2869,15 @@ async def main():
                             base_url="https://teamwork.tf"
                         ) as teamwork_session:
                             await query_runner(
-                                geoasn,
                                 geoip,
                                 api_session,
                                 cdn_session,
                                 comfig_session,
                                 teamwork_session,
                             )
+    finally:
+        if http_runner is not None:
+            await http_runner.cleanup()
 
 
 def start():
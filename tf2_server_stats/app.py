@@ -1,18 +1,29 @@
+import array
 import asyncio
 import datetime
+import gzip
+import hashlib
+import heapq
 import ipaddress
 import math
 import os
 import random
+import signal
+import sqlite3
 import sys
 import time
 import traceback
+from bisect import bisect_left
 from collections import defaultdict
-from collections.abc import Callable
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
+from typing import NamedTuple
 
 import a2s
 import aiohttp
+import brotli
 import orjson
 import tinydb
 from dotenv import load_dotenv
@@ -49,6 +60,43 @@ APP_FULL_NAME = "Team Fortress"
 DB = tinydb.TinyDB(Path("./db_servers.json"))
 ban_table = DB.table("bans")
 
+SIGHTINGS_DB_PATH = Path("./sightings.db")
+# failed sightings writes kept for retrying, before the oldest are dropped
+SIGHTINGS_MAX_PENDING = 16
+# the full player and stats files are exported at most this often, or on SIGUSR1
+EXPORT_INTERVAL = 60 * 60
+EXPORT_CHUNK_SIZE = 1024
+EXPORT_BROTLI = os.getenv("SERVER_STATS_EXPORT_BROTLI") is not None
+EXPORT_BROTLI_QUALITY = 5
+# players are also exported with map and server tables, as this version
+EXPORT_COMPACT_VERSION = 2
+EXPORT_BINARY = os.getenv("SERVER_STATS_EXPORT_BINARY") is not None
+# writes queued for the output thread before the collector waits on it
+OUTPUT_MAX_PENDING = 8
+# rolling windows of unique player estimates: name -> (bucket seconds, buckets)
+UNIQUE_WINDOWS = {"hour": (10 * 60, 6), "day": (60 * 60, 24)}
+# HyperLogLog precision p, using 2 ** p bytes per bucket for 1.04 / sqrt(2 ** p) error
+UNIQUE_PRECISION = 14
+UNIQUE_MAP_PRECISION = 10
+UNIQUE_SERVER_PRECISION = 7
+# rolling windows of the most populated maps, servers and tags, like UNIQUE_WINDOWS
+TOP_WINDOWS = {"hour": (10 * 60, 6), "day": (60 * 60, 24)}
+# Space-Saving counters kept per bucket, and how many of the heaviest are reported
+TOP_MAP_CAPACITY = 256
+TOP_SERVER_CAPACITY = 512
+TOP_TAG_CAPACITY = 64
+TOP_COUNT = 20
+# players not seen for this many days are evicted, if set
+RETENTION_DAYS = os.getenv("SERVER_STATS_RETENTION_DAYS")
+RETENTION = float(RETENTION_DAYS) * 24 * 60 * 60 if RETENTION_DAYS else None
+# evicted players are appended here as gzipped JSON lines, if set
+ARCHIVE_PATH = os.getenv("SERVER_STATS_ARCHIVE_PATH")
+# granularity of the last seen index, so eviction can run up to this late
+RETENTION_BUCKET = 60 * 60
+# per cycle population log, one fixed-width column per file
+TIMESERIES_PATH = Path("./timeseries")
+TIMESERIES_SCOPES = ("maps", "servers", "tags")
+
 TIMESTAMP_TIMEZONE = datetime.timezone.utc
 
 
@@ -119,20 +167,1293 @@ def shuffle(val, pct=0.1) -> float:
     return val + random.normalvariate(0, math.sqrt(val * pct))
 
 
-all_player_names: dict[str, float] = {}
-player_names: dict[str, float] = {}
-player_counts: dict[str, int] = defaultdict(int)
+class Interner:
+    """
+    Maps names to dense integer IDs, in the order they were first seen.
+    Released IDs are reused by the next new names.
+    """
+
+    __slots__ = ("ids", "names", "free")
+
+    def __init__(self):
+        self.ids: dict[str, int] = {}
+        self.names: list[str | None] = []
+        self.free: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def intern(self, name: str) -> int:
+        name_id = self.ids.get(name)
+        if name_id is None:
+            if self.free:
+                name_id = self.free.pop()
+                self.names[name_id] = name
+            else:
+                name_id = len(self.names)
+                self.names.append(name)
+            self.ids[name] = name_id
+        return name_id
+
+    def restore(self, name_id: int, name: str):
+        """
+        Interns a name with the ID it had before, in ascending order of IDs.
+        """
+        while len(self.names) < name_id:
+            self.free.append(len(self.names))
+            self.names.append(None)
+        self.ids[name] = name_id
+        self.names.append(name)
+
+    def release(self, name_id: int):
+        del self.ids[self.names[name_id]]
+        self.names[name_id] = None
+        self.free.append(name_id)
+
+
+EMPTY_IDS = array.array("I")
+
+
+class Relation:
+    """
+    A many-to-many relation between interned IDs.
+    Each left ID has a sorted array of right IDs, and each right ID a count of left IDs.
+    """
 
-map_players: dict[str, set[str]] = defaultdict(set)
-player_maps: dict[str, set[str]] = defaultdict(set)
+    __slots__ = ("rows", "counts")
 
-server_players: dict[str, set[str]] = defaultdict(set)
-player_servers: dict[str, set[str]] = defaultdict(set)
+    def __init__(self):
+        self.rows: list[array.array] = []
+        self.counts = array.array("I")
+
+    def add(self, left: int, right: int) -> bool:
+        rows = self.rows
+        while len(rows) <= left:
+            rows.append(array.array("I"))
+        row = rows[left]
+        idx = bisect_left(row, right)
+        if idx < len(row) and row[idx] == right:
+            return False
+        row.insert(idx, right)
+        counts = self.counts
+        if len(counts) <= right:
+            counts.extend([0] * (right + 1 - len(counts)))
+        counts[right] += 1
+        return True
+
+    def load_row(self, left: int, row: array.array):
+        """
+        Sets the sorted row of a left ID that has none yet.
+        """
+        rows = self.rows
+        while len(rows) <= left:
+            rows.append(array.array("I"))
+        rows[left] = row
+        counts = self.counts
+        if row and len(counts) <= row[-1]:
+            counts.extend([0] * (row[-1] + 1 - len(counts)))
+        for right in row:
+            counts[right] += 1
+
+    def get(self, left: int) -> array.array:
+        if left < len(self.rows):
+            return self.rows[left]
+        return EMPTY_IDS
+
+    def clear(self, left: int):
+        if left < len(self.rows):
+            counts = self.counts
+            for right in self.rows[left]:
+                counts[right] -= 1
+            self.rows[left] = array.array("I")
+
+
+player_ids = Interner()
+map_ids = Interner()
+server_ids = Interner()
+
+# per player ID: last seen anywhere, last seen where counted (0 if never), max count
+player_seen = array.array("d")
+player_counted_seen = array.array("d")
+player_counts = array.array("I")
+# per player ID: hash of the name, for the unique player sketches
+player_hashes = array.array("Q")
+# players with a counted sighting, so it needn't be counted every cycle
+counted_players = 0
+
+player_maps = Relation()
+player_servers = Relation()
 
 server_capacities: dict[str, int] = defaultdict(int)
 tags: dict[str, int] = defaultdict(int)
 
 
+def grow_players(size: int):
+    missing = size - len(player_seen)
+    if missing > 0:
+        player_seen.extend([0] * missing)
+        player_counted_seen.extend([0] * missing)
+        player_counts.extend([0] * missing)
+        player_hashes.extend([0] * missing)
+
+
+def intern_player(name: str) -> int:
+    player_id = player_ids.ids.get(name)
+    if player_id is None:
+        player_id = player_ids.intern(name)
+        grow_players(player_id + 1)
+        player_hashes[player_id] = hash_name(name)
+    return player_id
+
+
+class LastSeenIndex:
+    """
+    Groups player IDs into buckets by when they were last seen, oldest first.
+    Eviction pops whole buckets instead of scanning every player.
+    """
+
+    __slots__ = ("buckets", "order")
+
+    def __init__(self):
+        self.buckets: dict[int, set[int]] = {}
+        self.order: list[int] = []
+
+    def update(self, player_id: int, old_seen: float, new_seen: float):
+        old_bucket = int(old_seen // RETENTION_BUCKET)
+        new_bucket = int(new_seen // RETENTION_BUCKET)
+        if old_seen and old_bucket == new_bucket:
+            return
+        if old_seen:
+            bucket = self.buckets.get(old_bucket)
+            if bucket is not None:
+                bucket.discard(player_id)
+        bucket = self.buckets.get(new_bucket)
+        if bucket is None:
+            bucket = self.buckets[new_bucket] = set()
+            heapq.heappush(self.order, new_bucket)
+        bucket.add(player_id)
+
+    def pop_before(self, cutoff: float) -> list[int]:
+        """
+        Removes and returns the players last seen in buckets wholly before cutoff.
+        """
+        limit = int(cutoff // RETENTION_BUCKET)
+        order = self.order
+        player_ids = []
+        while order and order[0] < limit:
+            player_ids.extend(self.buckets.pop(heapq.heappop(order)))
+        return player_ids
+
+
+last_seen_index = LastSeenIndex()
+
+
+def evict_players(cutoff: float) -> tuple[list[int], list[dict]]:
+    """
+    Forgets players last seen before cutoff, freeing their IDs for reuse.
+    Returns their IDs, and their entries if they are to be archived.
+    """
+    global counted_players
+    evicted = last_seen_index.pop_before(cutoff)
+    records = []
+    for player_id in evicted:
+        if ARCHIVE_PATH:
+            records.append(
+                {
+                    "name": player_ids.names[player_id],
+                    "count": player_counts[player_id],
+                    "seen": player_seen[player_id],
+                    "counted_seen": player_counted_seen[player_id],
+                    "maps": [map_ids.names[i] for i in player_maps.get(player_id)],
+                    "servers": [
+                        server_ids.names[i] for i in player_servers.get(player_id)
+                    ],
+                }
+            )
+        player_ids.release(player_id)
+        if player_counted_seen[player_id]:
+            counted_players -= 1
+        player_seen[player_id] = 0
+        player_counted_seen[player_id] = 0
+        player_counts[player_id] = 0
+        player_hashes[player_id] = 0
+        player_maps.clear(player_id)
+        player_servers.clear(player_id)
+    return evicted, records
+
+
+def archive_players(path: Path, records: list[dict]):
+    """
+    Appends evicted players to the archive, one JSON object per line.
+    """
+    with gzip.open(path, "ab") as fp:
+        for record in records:
+            fp.write(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE))
+
+
+def hash_name(name: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(encode_name(name), digest_size=8).digest(), "little"
+    )
+
+
+HLL_POWERS = [2.0**-rank for rank in range(65)]
+
+
+def hll_estimate(registers: bytes) -> float:
+    """
+    Estimates the cardinality of a HyperLogLog sketch.
+    """
+    m = len(registers)
+    alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+    # count each rank in C rather than summing register by register
+    harmonic = sum(
+        registers.count(rank) * HLL_POWERS[rank] for rank in range(max(registers) + 1)
+    )
+    estimate = alpha * m * m / harmonic
+    if estimate <= 2.5 * m:
+        zeros = registers.count(0)
+        if zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+    return estimate
+
+
+def hll_merge(sketches: Iterable[bytes]) -> bytes:
+    """
+    Merges sketches by taking the max of each register, a whole sketch at a time.
+    Registers are below 0x80, so in (a | 0x80) - b each byte keeps its high bit
+    exactly when a >= b, without borrowing from the next byte.
+    """
+    sketches = iter(sketches)
+    merged = next(sketches)
+    size = len(merged)
+    high = int.from_bytes(b"\x80" * size, "little")
+    merged = int.from_bytes(merged, "little")
+    for registers in sketches:
+        registers = int.from_bytes(registers, "little")
+        greater = (((merged | high) - registers) & high) >> 7
+        # spread each byte's flag to 0xff to select the greater register
+        mask = (greater << 8) - greater
+        merged = registers ^ ((merged ^ registers) & mask)
+    return merged.to_bytes(size, "little")
+
+
+class RollingUniques:
+    """
+    Estimates unique players per key over each of the UNIQUE_WINDOWS.
+    A window is a ring of HyperLogLog sketches, one per time bucket, which are
+    merged when estimating, so memory only depends on the keys active in a window.
+    """
+
+    __slots__ = ("precision", "sketches", "changed")
+
+    def __init__(self, precision: int):
+        self.precision = precision
+        # key -> window -> bucket -> registers
+        self.sketches: dict[int, dict[str, dict[int, bytearray]]] = {}
+        self.changed: set[tuple[int, str, int]] = set()
+
+    def add(self, key: int, hashed: int, now: float):
+        precision = self.precision
+        index = hashed >> (64 - precision)
+        rest = hashed & ((1 << (64 - precision)) - 1)
+        rank = 64 - precision - rest.bit_length() + 1
+        windows = self.sketches.get(key)
+        if windows is None:
+            windows = self.sketches[key] = {window: {} for window in UNIQUE_WINDOWS}
+        for window, (length, _) in UNIQUE_WINDOWS.items():
+            bucket = int(now // length)
+            buckets = windows[window]
+            registers = buckets.get(bucket)
+            if registers is None:
+                registers = buckets[bucket] = bytearray(1 << precision)
+            if rank > registers[index]:
+                registers[index] = rank
+                self.changed.add((key, window, bucket))
+
+    def expire(self, now: float):
+        for key, windows in list(self.sketches.items()):
+            for window, buckets in windows.items():
+                length, count = UNIQUE_WINDOWS[window]
+                oldest = int(now // length) - count + 1
+                for bucket in [bucket for bucket in buckets if bucket < oldest]:
+                    del buckets[bucket]
+            if not any(windows.values()):
+                del self.sketches[key]
+
+    def copy(self) -> dict[int, dict[str, list[bytes]]]:
+        return {
+            key: {
+                window: [bytes(registers) for registers in buckets.values()]
+                for window, buckets in windows.items()
+                if buckets
+            }
+            for key, windows in self.sketches.items()
+        }
+
+    def take_changed(self) -> list[tuple[int, str, int, float, bytes]]:
+        """
+        Copies out the sketches changed since the last call, with their expiry time.
+        """
+        changed = []
+        for key, window, bucket in self.changed:
+            registers = self.sketches.get(key, EMPTY_DICT).get(window, EMPTY_DICT)
+            if bucket in registers:
+                length, count = UNIQUE_WINDOWS[window]
+                expires = (bucket + count) * length
+                changed.append((key, window, bucket, expires, bytes(registers[bucket])))
+        self.changed = set()
+        return changed
+
+
+def estimate_uniques(
+    sketches: dict[int, dict[str, list[bytes]]],
+) -> dict[int, dict[str, int]]:
+    return {
+        key: {
+            window: round(hll_estimate(hll_merge(registers)))
+            for window, registers in windows.items()
+        }
+        for key, windows in sketches.items()
+    }
+
+
+def write_unique_players(
+    path: Path,
+    sketches: dict[str, dict[int, dict[str, list[bytes]]]],
+    map_names: list[str],
+    server_names: list[str],
+):
+    """
+    Writes the unique player estimates overall, per map and per server.
+    """
+    players = estimate_uniques(sketches["players"])
+    maps = estimate_uniques(sketches["maps"])
+    servers = estimate_uniques(sketches["servers"])
+    write_json(
+        path,
+        {
+            "players": players.get(0, EMPTY_DICT),
+            "maps": {
+                map_names[key]: counts
+                for key, counts in maps.items()
+                if map_names[key] is not None
+            },
+            "servers": {
+                server_names[key]: counts
+                for key, counts in servers.items()
+                if server_names[key] is not None
+            },
+        },
+    )
+
+
+unique_players = RollingUniques(UNIQUE_PRECISION)
+map_unique_players = RollingUniques(UNIQUE_MAP_PRECISION)
+server_unique_players = RollingUniques(UNIQUE_SERVER_PRECISION)
+UNIQUE_SCOPES = {
+    "players": unique_players,
+    "maps": map_unique_players,
+    "servers": server_unique_players,
+}
+
+
+class SpaceSaving:
+    """
+    Keeps the approximate weights of the heaviest keys of a stream in a fixed number
+    of counters. A weight can be overestimated by at most its error.
+    """
+
+    __slots__ = ("capacity", "counts", "errors")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: dict[str, int] = {}
+        self.errors: dict[str, int] = {}
+
+    def add(self, key: str, weight: int):
+        counts = self.counts
+        if key in counts:
+            counts[key] += weight
+        elif len(counts) < self.capacity:
+            counts[key] = weight
+            self.errors[key] = 0
+        else:
+            # the new key takes over the smallest counter, which bounds its error
+            smallest = min(counts, key=counts.__getitem__)
+            floor = counts.pop(smallest)
+            del self.errors[smallest]
+            counts[key] = floor + weight
+            self.errors[key] = floor
+
+    def floor(self) -> int:
+        """
+        The most a key that isn't counted could weigh.
+        """
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+
+class RollingTop:
+    """
+    Tracks the most populated keys over each of the TOP_WINDOWS.
+    A window is a ring of Space-Saving summaries, one per time bucket, which are
+    merged when reporting, so memory and report cost are bounded by the capacity.
+    """
+
+    __slots__ = ("capacity", "summaries", "cycles", "pruned")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        # window -> bucket -> summary, cycles added and weight pruned per key
+        self.summaries: dict[str, dict[int, SpaceSaving]] = {
+            window: {} for window in TOP_WINDOWS
+        }
+        self.cycles: dict[str, dict[int, int]] = {window: {} for window in TOP_WINDOWS}
+        self.pruned: dict[str, dict[int, int]] = {window: {} for window in TOP_WINDOWS}
+
+    def add_cycle(self, weights: dict[str, int], now: float):
+        # a cycle's weights are exact, so only its heaviest keys need to be summarized,
+        # which keeps the many light keys from churning out the heavy ones
+        heaviest = heapq.nlargest(self.capacity + 1, weights.items(), key=by_value)
+        pruned = 0
+        if len(heaviest) > self.capacity:
+            pruned = heaviest.pop()[1]
+        for window, (length, count) in TOP_WINDOWS.items():
+            summaries = self.summaries[window]
+            cycles = self.cycles[window]
+            bucket = int(now // length)
+            oldest = bucket - count + 1
+            for expired in [expired for expired in summaries if expired < oldest]:
+                del summaries[expired]
+                del cycles[expired]
+                del self.pruned[window][expired]
+            summary = summaries.get(bucket)
+            if summary is None:
+                summary = summaries[bucket] = SpaceSaving(self.capacity)
+                cycles[bucket] = 0
+                self.pruned[window][bucket] = 0
+            cycles[bucket] += 1
+            self.pruned[window][bucket] += pruned
+            for key, weight in heaviest:
+                summary.add(key, weight)
+
+    def top(self, window: str) -> list[dict]:
+        """
+        Lists the heaviest keys of a window by their average players per cycle.
+        """
+        cycles = sum(self.cycles[window].values())
+        if not cycles:
+            return []
+        counts = defaultdict(int)
+        errors = defaultdict(int)
+        # a key may have been in a bucket without being counted there
+        counted_floor = defaultdict(int)
+        total_floor = sum(self.pruned[window].values())
+        for summary in self.summaries[window].values():
+            floor = summary.floor()
+            total_floor += floor
+            for key, count in summary.counts.items():
+                counts[key] += count
+                errors[key] += summary.errors[key]
+                counted_floor[key] += floor
+        heaviest = heapq.nlargest(TOP_COUNT, counts.items(), key=by_value)
+        return [
+            {
+                "name": key,
+                "players": round(count / cycles, 1),
+                "error": round(
+                    (errors[key] + total_floor - counted_floor[key]) / cycles, 1
+                ),
+            }
+            for key, count in heaviest
+        ]
+
+    def report(self) -> dict[str, list[dict]]:
+        return {window: self.top(window) for window in TOP_WINDOWS}
+
+
+top_maps = RollingTop(TOP_MAP_CAPACITY)
+top_servers = RollingTop(TOP_SERVER_CAPACITY)
+top_tags = RollingTop(TOP_TAG_CAPACITY)
+
+
+def iter_json_list(records: Iterable[dict]) -> Iterator[bytes]:
+    """
+    Encodes records as an indented JSON list, a chunk of records at a time.
+    """
+    records = iter(records)
+    separator = b"[\n"
+    while chunk := list(islice(records, EXPORT_CHUNK_SIZE)):
+        yield separator
+        # strip the brackets so that the chunks join into a single list
+        yield orjson.dumps(chunk, option=orjson.OPT_INDENT_2)[2:-2]
+        separator = b",\n"
+    yield b"[]" if separator == b"[\n" else b"\n]"
+
+
+def export_json(path: Path, records: Iterable[dict]):
+    export_chunks(path, iter_json_list(records))
+
+
+def export_chunks(path: Path, chunks: Iterable[bytes]):
+    """
+    Streams chunks to a temporary file, then renames it over path.
+    With EXPORT_BROTLI, a brotli compressed copy is streamed to path.br too.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    br_path = path.with_name(path.name + ".br")
+    br_tmp_path = br_path.with_name(br_path.name + ".tmp")
+    with open(tmp_path, "wb") as fp:
+        if EXPORT_BROTLI:
+            compressor = brotli.Compressor(quality=EXPORT_BROTLI_QUALITY)
+            with open(br_tmp_path, "wb") as br_fp:
+                for data in chunks:
+                    fp.write(data)
+                    br_fp.write(compressor.process(data))
+                br_fp.write(compressor.finish())
+                br_fp.flush()
+                os.fsync(br_fp.fileno())
+        else:
+            for data in chunks:
+                fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+    if EXPORT_BROTLI:
+        os.replace(br_tmp_path, br_path)
+
+
+def write_atomic(path: Path, data: bytes):
+    """
+    Writes a file so that readers only ever see the old or the new contents.
+    """
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_json(path: Path, obj):
+    write_atomic(path, orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+
+
+class OutputWriter:
+    """
+    Runs file output on a dedicated thread, in the order it was submitted.
+    Submitting waits while too many writes are pending, so a slow disk holds back
+    the collector instead of piling up data in memory.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="output")
+        self.slots = asyncio.Semaphore(OUTPUT_MAX_PENDING)
+
+    async def submit(self, fn: Callable[..., None], *args):
+        await self.slots.acquire()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        future.add_done_callback(self.done)
+
+    def done(self, future: asyncio.Future):
+        self.slots.release()
+        if not future.cancelled() and future.exception() is not None:
+            traceback.print_exception(future.exception())
+
+
+output_writer = OutputWriter()
+
+
+SIGHTINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+    id INTEGER PRIMARY KEY,
+    name BLOB NOT NULL UNIQUE,
+    seen REAL NOT NULL,
+    counted_seen REAL NOT NULL,
+    count INTEGER NOT NULL,
+    maps BLOB NOT NULL,
+    servers BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS maps (
+    id INTEGER PRIMARY KEY,
+    name BLOB NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS servers (
+    id INTEGER PRIMARY KEY,
+    name BLOB NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS player_maps (
+    player_id INTEGER NOT NULL,
+    map_id INTEGER NOT NULL,
+    PRIMARY KEY (player_id, map_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS player_maps_map ON player_maps (map_id);
+CREATE TABLE IF NOT EXISTS player_servers (
+    player_id INTEGER NOT NULL,
+    server_id INTEGER NOT NULL,
+    PRIMARY KEY (player_id, server_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS player_servers_server ON player_servers (server_id);
+CREATE TABLE IF NOT EXISTS tags (
+    name BLOB PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS capacities (
+    max_players BLOB PRIMARY KEY,
+    count INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS unique_sketches (
+    scope TEXT NOT NULL,
+    key INTEGER NOT NULL,
+    period TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    registers BLOB NOT NULL,
+    PRIMARY KEY (scope, key, period, bucket)
+) WITHOUT ROWID;
+"""
+
+UPSERT_PLAYER = """
+INSERT INTO players (id, name, seen, counted_seen, count, maps, servers)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id) DO UPDATE SET
+    seen = excluded.seen,
+    counted_seen = excluded.counted_seen,
+    count = excluded.count,
+    maps = excluded.maps,
+    servers = excluded.servers
+"""
+
+
+def encode_name(name: str) -> bytes:
+    # cleaned up server names can hold lone surrogates, which UTF-8 text can't
+    return name.encode("utf-8", "surrogatepass")
+
+
+def decode_name(name: bytes) -> str:
+    return name.decode("utf-8", "surrogatepass")
+
+
+def unpack_ids(data: bytes) -> array.array:
+    ids = array.array("I")
+    ids.frombytes(data)
+    return ids
+
+
+class SightingChanges(NamedTuple):
+    """
+    Everything that changed since the sightings were last written, copied out.
+    Players carry their maps and servers as packed ID arrays.
+    """
+
+    players: list[tuple[int, str, float, float, int, bytes, bytes]]
+    maps: list[tuple[int, str]]
+    servers: list[tuple[int, str]]
+    map_edges: list[tuple[int, int]]
+    server_edges: list[tuple[int, int]]
+    tags: list[tuple[str, int]]
+    capacities: list[tuple[str, int]]
+    sketches: list[tuple[str, int, str, int, float, bytes]]
+
+
+class SightingTracker:
+    """
+    Tracks what changed since the sightings were last written.
+    Changes carry over until taken, so a cycle that fails part way is written with
+    the next one instead of leaving gaps in the store.
+    """
+
+    def __init__(self):
+        self.maps: list[int] = []
+        self.servers: list[int] = []
+        self.players: set[int] = set()
+        self.map_edges: list[tuple[int, int]] = []
+        self.server_edges: list[tuple[int, int]] = []
+        self.tags: set[str] = set()
+        self.capacities: set[str] = set()
+
+    def intern_map(self, name: str) -> int:
+        map_id = map_ids.ids.get(name)
+        if map_id is None:
+            map_id = map_ids.intern(name)
+            self.maps.append(map_id)
+        return map_id
+
+    def intern_server(self, name: str) -> int:
+        server_id = server_ids.ids.get(name)
+        if server_id is None:
+            server_id = server_ids.intern(name)
+            self.servers.append(server_id)
+        return server_id
+
+    def take(self) -> SightingChanges:
+        changes = SightingChanges(
+            [
+                (
+                    player_id,
+                    player_ids.names[player_id],
+                    player_seen[player_id],
+                    player_counted_seen[player_id],
+                    player_counts[player_id],
+                    player_maps.get(player_id).tobytes(),
+                    player_servers.get(player_id).tobytes(),
+                )
+                for player_id in self.players
+            ],
+            [(map_id, map_ids.names[map_id]) for map_id in self.maps],
+            [(server_id, server_ids.names[server_id]) for server_id in self.servers],
+            self.map_edges,
+            self.server_edges,
+            [(tag, tags[tag]) for tag in self.tags],
+            [(cap, server_capacities[cap]) for cap in self.capacities],
+            [
+                (scope, *sketch)
+                for scope, uniques in UNIQUE_SCOPES.items()
+                for sketch in uniques.take_changed()
+            ],
+        )
+        self.__init__()
+        return changes
+
+
+class SightingStore:
+    """
+    Persists player sightings and stats in SQLite, keyed by the interned IDs.
+    Each write only carries what changed, so it doubles as an incremental checkpoint.
+    After loading, it is only used from the output writer thread.
+    """
+
+    def __init__(self, path: Path):
+        # writes that failed, retried in order before the next one
+        self.pending: list[tuple[Callable[[object], None], object]] = []
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SIGHTINGS_SCHEMA)
+
+    def load(self):
+        """
+        Restores the interned names, sightings, relations and stats.
+        """
+        global counted_players
+        db = self.db
+        # players refer to maps and servers by ID, so they keep them even with gaps
+        for map_id, name in db.execute("SELECT id, name FROM maps ORDER BY id"):
+            map_ids.restore(map_id, decode_name(name))
+        for server_id, name in db.execute("SELECT id, name FROM servers ORDER BY id"):
+            server_ids.restore(server_id, decode_name(name))
+        # players may still refer to the IDs of names that were lost, so never reuse them
+        map_ids.free.clear()
+        server_ids.free.clear()
+        for player_id, name, seen, counted_seen, count, maps, servers in db.execute("""
+            SELECT id, name, seen, counted_seen, count, maps, servers
+            FROM players ORDER BY id
+            """):
+            # evicted players leave holes in the IDs
+            name = decode_name(name)
+            player_ids.restore(player_id, name)
+            grow_players(player_id + 1)
+            player_hashes[player_id] = hash_name(name)
+            if RETENTION:
+                last_seen_index.update(player_id, 0, seen)
+            player_seen[player_id] = seen
+            player_counted_seen[player_id] = counted_seen
+            if counted_seen:
+                counted_players += 1
+            player_counts[player_id] = count
+            # the packed rows load much faster than the relation tables
+            player_maps.load_row(player_id, unpack_ids(maps))
+            player_servers.load_row(player_id, unpack_ids(servers))
+        for name, count in db.execute("SELECT name, count FROM tags"):
+            tags[decode_name(name)] = count
+        for max_players, count in db.execute(
+            "SELECT max_players, count FROM capacities"
+        ):
+            server_capacities[decode_name(max_players)] = count
+        for scope, key, window, bucket, registers in db.execute(
+            """
+            SELECT scope, key, period, bucket, registers
+            FROM unique_sketches WHERE expires > ?
+            """,
+            (utcnow().timestamp(),),
+        ):
+            uniques = UNIQUE_SCOPES.get(scope)
+            # skip sketches left over from other windows or precisions
+            if (
+                uniques is None
+                or window not in UNIQUE_WINDOWS
+                or len(registers) != 1 << uniques.precision
+            ):
+                continue
+            windows = uniques.sketches.setdefault(
+                key, {window: {} for window in UNIQUE_WINDOWS}
+            )
+            windows[window][bucket] = bytearray(registers)
+
+    def commit(self, apply: Callable[[object], None], arg):
+        """
+        Applies a write in one transaction, along with any that failed before it.
+        If it fails on a database error, it is kept to be retried with the next one,
+        since the collector has already moved on.
+        """
+        self.pending.append((apply, arg))
+        try:
+            with self.db:
+                for pending_apply, pending_arg in self.pending:
+                    pending_apply(pending_arg)
+        except sqlite3.OperationalError:
+            # likely transient, like a locked or full disk, so retry with the next one
+            if len(self.pending) > SIGHTINGS_MAX_PENDING:
+                print("Dropping a sightings write after too many failures")
+                del self.pending[0]
+            raise
+        except Exception:
+            # anything else would just fail again, and hold back every later write
+            print("Dropping", len(self.pending), "sightings writes")
+            self.pending.clear()
+            raise
+        self.pending.clear()
+
+    def write(self, changes: SightingChanges):
+        self.commit(self.apply_changes, changes)
+
+    def evict(self, player_ids: list[int]):
+        """
+        Deletes evicted players, before their IDs can be written for new ones.
+        """
+        self.commit(self.apply_evict, player_ids)
+
+    def apply_changes(self, changes: SightingChanges):
+        db = self.db
+        db.executemany(
+            "INSERT OR IGNORE INTO maps (id, name) VALUES (?, ?)",
+            ((map_id, encode_name(name)) for map_id, name in changes.maps),
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO servers (id, name) VALUES (?, ?)",
+            ((server_id, encode_name(name)) for server_id, name in changes.servers),
+        )
+        db.executemany(
+            UPSERT_PLAYER,
+            (
+                (player_id, encode_name(name), *sightings)
+                for player_id, name, *sightings in changes.players
+            ),
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO player_maps VALUES (?, ?)", changes.map_edges
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO player_servers VALUES (?, ?)",
+            changes.server_edges,
+        )
+        db.executemany(
+            "INSERT OR REPLACE INTO tags VALUES (?, ?)",
+            ((encode_name(tag), count) for tag, count in changes.tags),
+        )
+        db.executemany(
+            "INSERT OR REPLACE INTO capacities VALUES (?, ?)",
+            ((encode_name(cap), count) for cap, count in changes.capacities),
+        )
+        db.executemany(
+            "INSERT OR REPLACE INTO unique_sketches VALUES (?, ?, ?, ?, ?, ?)",
+            changes.sketches,
+        )
+        db.execute(
+            "DELETE FROM unique_sketches WHERE expires <= ?",
+            (utcnow().timestamp(),),
+        )
+
+    def apply_evict(self, player_ids: list[int]):
+        db = self.db
+        rows = [(player_id,) for player_id in player_ids]
+        db.executemany("DELETE FROM players WHERE id = ?", rows)
+        db.executemany("DELETE FROM player_maps WHERE player_id = ?", rows)
+        db.executemany("DELETE FROM player_servers WHERE player_id = ?", rows)
+
+    def read_names(self, table: str) -> list[bytes]:
+        """
+        Reads the names of a table, indexed by their ID.
+        """
+        names = []
+        for name_id, name in self.db.execute(
+            f"SELECT id, name FROM {table} ORDER BY id"
+        ):
+            # nothing refers to the IDs of names that were never written
+            names.extend([b""] * (name_id - len(names)))
+            names.append(name)
+        return names
+
+    def iter_player_rows(self, counted: bool) -> Iterator[tuple]:
+        """
+        Yields players by name, with their maps and servers packed.
+        """
+        seen_column = "counted_seen" if counted else "seen"
+        # names are UTF-8 blobs, so they sort by code point just like str
+        return self.db.execute(f"""
+            SELECT name, count, {seen_column}, maps, servers
+            FROM players
+            {"WHERE counted_seen != 0" if counted else ""}
+            ORDER BY name
+            """)
+
+    def iter_player_entries(self, counted: bool) -> Iterator[dict]:
+        """
+        Yields players by name with their maps and servers, as of the last write.
+        """
+        map_names = [decode_name(name) for name in self.read_names("maps")]
+        server_names = [decode_name(name) for name in self.read_names("servers")]
+        for name, count, last_seen, maps, servers in self.iter_player_rows(counted):
+            yield {
+                "name": decode_name(name),
+                "count": count,
+                "seen": last_seen,
+                "maps": [map_names[i] for i in unpack_ids(maps)],
+                "servers": [server_names[i] for i in unpack_ids(servers)],
+            }
+
+    def iter_compact_players(self, counted: bool) -> Iterator[bytes]:
+        """
+        Encodes players as a JSON object with tables of map and server names, and a
+        row per player that refers to them by index.
+        """
+        header = {
+            "version": EXPORT_COMPACT_VERSION,
+            "fields": ["name", "count", "seen", "maps", "servers"],
+            "maps": [decode_name(name) for name in self.read_names("maps")],
+            "servers": [decode_name(name) for name in self.read_names("servers")],
+        }
+        # leave the object open for the players
+        yield orjson.dumps(header)[:-1] + b',"players":['
+        rows = self.iter_player_rows(counted)
+        separator = b""
+        while chunk := list(islice(rows, EXPORT_CHUNK_SIZE)):
+            yield separator
+            yield orjson.dumps(
+                [
+                    [
+                        decode_name(name),
+                        count,
+                        last_seen,
+                        unpack_ids(maps).tolist(),
+                        unpack_ids(servers).tolist(),
+                    ]
+                    for name, count, last_seen, maps, servers in chunk
+                ]
+            )[1:-1]
+            separator = b","
+        yield b"]}"
+
+    def iter_binary_players(self, counted: bool) -> Iterator[bytes]:
+        """
+        Encodes players as columns of fixed-width native numbers, like the time
+        series. The file starts with the length of a JSON header as a little-endian
+        u32, then the header, which gives the type, offset and size of each column.
+        Offsets count from the end of the header, and are multiples of 8.
+
+        Strings are UTF-8 bytes in a u8 column, each ending at its entry in the
+        matching _ends column. Player maps and servers are indexes into map_names and
+        server_names, with each player's ending at its entry in map_ends or
+        server_ends.
+        """
+        columns: dict[str, tuple[str, bytes | bytearray | array.array]] = {}
+        for table, prefix in (("maps", "map"), ("servers", "server")):
+            table_names = self.read_names(table)
+            table_name_ends = array.array("Q")
+            end = 0
+            for name in table_names:
+                end += len(name)
+                table_name_ends.append(end)
+            columns[f"{prefix}_names"] = ("u8", b"".join(table_names))
+            columns[f"{prefix}_name_ends"] = ("u64", table_name_ends)
+        names = bytearray()
+        name_ends = array.array("Q")
+        counts = array.array("I")
+        last_seens = array.array("d")
+        map_refs = array.array("I")
+        map_ends = array.array("Q")
+        server_refs = array.array("I")
+        server_ends = array.array("Q")
+        for name, count, last_seen, maps, servers in self.iter_player_rows(counted):
+            names += name
+            name_ends.append(len(names))
+            counts.append(count)
+            last_seens.append(last_seen)
+            # the rows are packed just like the columns, so they are copied as is
+            map_refs.frombytes(maps)
+            map_ends.append(len(map_refs))
+            server_refs.frombytes(servers)
+            server_ends.append(len(server_refs))
+        columns["names"] = ("u8", names)
+        columns["name_ends"] = ("u64", name_ends)
+        columns["count"] = ("u32", counts)
+        columns["seen"] = ("f64", last_seens)
+        columns["maps"] = ("u32", map_refs)
+        columns["map_ends"] = ("u64", map_ends)
+        columns["servers"] = ("u32", server_refs)
+        columns["server_ends"] = ("u64", server_ends)
+
+        layout = {}
+        offset = 0
+        for column, (column_type, data) in columns.items():
+            size = len(memoryview(data).cast("B"))
+            layout[column] = {"type": column_type, "offset": offset, "size": size}
+            offset += -(-size // 8) * 8
+        header = orjson.dumps(
+            {
+                "version": EXPORT_COMPACT_VERSION,
+                "byteorder": sys.byteorder,
+                "players": len(counts),
+                "columns": layout,
+            }
+        )
+        header += b" " * (-(4 + len(header)) % 8)
+        yield len(header).to_bytes(4, "little")
+        yield header
+        for _, data in columns.values():
+            data = memoryview(data).cast("B")
+            yield data
+            yield bytes(-len(data) % 8)
+
+    def export_players(self, path: Path, counted: bool):
+        export_json(path, self.iter_player_entries(counted))
+        compact_path = path.with_suffix(f".v{EXPORT_COMPACT_VERSION}.json")
+        export_chunks(compact_path, self.iter_compact_players(counted))
+        if EXPORT_BINARY:
+            export_chunks(
+                compact_path.with_suffix(".bin"), self.iter_binary_players(counted)
+            )
+
+
+class TimeSeriesLog:
+    """
+    Appends the population of each cycle to a columnar log, one file per column.
+    Columns are arrays of fixed-width native numbers, suffixed with their type, so
+    they can be memory mapped as they are:
+
+    time.f64, players.u32 and steam_players.i32 (-1 if unavailable) per cycle.
+    For each scope, {scope}.ends.u64 per cycle is where its entries end in
+    {scope}.keys.u32 and {scope}.counts.u32, sorted by key. Keys index the UTF-8
+    names concatenated in {scope}.names, each ending at its {scope}.name_ends.u64.
+
+    After opening, it is only used from the output writer thread.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.mkdir(parents=True, exist_ok=True)
+        self.names = {scope: Interner() for scope in TIMESERIES_SCOPES}
+        self.name_ends = dict.fromkeys(TIMESERIES_SCOPES, 0)
+        self.entries = dict.fromkeys(TIMESERIES_SCOPES, 0)
+        self.repair()
+
+    def read(self, column: str, typecode: str) -> array.array:
+        data = array.array(typecode)
+        path = self.path / column
+        if path.exists():
+            raw = path.read_bytes()
+            data.frombytes(raw[: len(raw) - len(raw) % data.itemsize])
+        return data
+
+    def truncate(self, column: str, size: int):
+        path = self.path / column
+        if path.exists() and path.stat().st_size > size:
+            os.truncate(path, size)
+
+    def append(self, column: str, data: array.array | bytes):
+        with open(self.path / column, "ab") as fp:
+            fp.write(data)
+
+    def repair(self):
+        """
+        Cuts off what an interrupted cycle left behind, and loads the names.
+        """
+        times = self.read("time.f64", "d")
+        players = self.read("players.u32", "I")
+        steam_players = self.read("steam_players.i32", "i")
+        ends = {
+            scope: self.read(f"{scope}.ends.u64", "Q") for scope in TIMESERIES_SCOPES
+        }
+        cycles = min(
+            len(times),
+            len(players),
+            len(steam_players),
+            *(len(scope_ends) for scope_ends in ends.values()),
+        )
+        self.truncate("time.f64", cycles * 8)
+        self.truncate("players.u32", cycles * 4)
+        self.truncate("steam_players.i32", cycles * 4)
+        for scope in TIMESERIES_SCOPES:
+            entries = ends[scope][cycles - 1] if cycles else 0
+            self.entries[scope] = entries
+            self.truncate(f"{scope}.ends.u64", cycles * 8)
+            self.truncate(f"{scope}.keys.u32", entries * 4)
+            self.truncate(f"{scope}.counts.u32", entries * 4)
+            names_path = self.path / f"{scope}.names"
+            names = names_path.read_bytes() if names_path.exists() else b""
+            start = 0
+            for name_end in self.read(f"{scope}.name_ends.u64", "Q"):
+                if name_end > len(names):
+                    break
+                self.names[scope].intern(decode_name(names[start:name_end]))
+                start = name_end
+            self.name_ends[scope] = start
+            self.truncate(f"{scope}.name_ends.u64", len(self.names[scope]) * 8)
+            self.truncate(f"{scope}.names", start)
+
+    def write(
+        self,
+        now: float,
+        players: int,
+        steam_players: int,
+        weights: dict[str, dict[str, int]],
+    ):
+        """
+        Appends a cycle, with the players on each map, server and tag in weights.
+        """
+        for scope in TIMESERIES_SCOPES:
+            interner = self.names[scope]
+            name_start = len(interner)
+            entries = sorted(
+                (interner.intern(name), count) for name, count in weights[scope].items()
+            )
+            # names go first, so entries never refer to a name that wasn't written
+            if len(interner) > name_start:
+                names = [encode_name(name) for name in interner.names[name_start:]]
+                name_ends = array.array("Q")
+                for name in names:
+                    self.name_ends[scope] += len(name)
+                    name_ends.append(self.name_ends[scope])
+                self.append(f"{scope}.names", b"".join(names))
+                self.append(f"{scope}.name_ends.u64", name_ends)
+            self.entries[scope] += len(entries)
+            self.append(f"{scope}.keys.u32", array.array("I", [k for k, _ in entries]))
+            self.append(
+                f"{scope}.counts.u32", array.array("I", [c for _, c in entries])
+            )
+            self.append(f"{scope}.ends.u64", array.array("Q", [self.entries[scope]]))
+        self.append("time.f64", array.array("d", [now]))
+        self.append("players.u32", array.array("I", [players]))
+        self.append("steam_players.i32", array.array("i", [steam_players]))
+
+
+# requests per second and burst shared by every Steam API endpoint
+STEAM_RATE = 20
+STEAM_BURST = 40
+# endpoint -> (requests per second, burst, concurrent requests)
+STEAM_ENDPOINT_LIMITS = {
+    "/IGameServersService/GetServerList/v1/": (1, 3, 2),
+    "/IGameServersService/QueryByFakeIP/v1/": (15, 30, 16),
+}
+STEAM_DEFAULT_ENDPOINT_LIMIT = (5, 10, 4)
+
+
+class TokenBucket:
+    """
+    Refills at rate tokens per second, holding at most burst tokens.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class EndpointLimit:
+    """
+    The token bucket, concurrency cap and queue wait metrics of an endpoint.
+    """
+
+    __slots__ = ("bucket", "semaphore", "requests", "wait_total", "wait_max")
+
+    def __init__(self, rate: float, burst: float, concurrency: int):
+        self.bucket = TokenBucket(rate, burst)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.requests = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class SteamRateLimiter:
+    """
+    Rate limits every request on the Steam API session, as a client middleware.
+    """
+
+    def __init__(self):
+        self.shared = TokenBucket(STEAM_RATE, STEAM_BURST)
+        self.endpoints: dict[str, EndpointLimit] = {}
+
+    def get_limit(self, path: str) -> EndpointLimit:
+        limit = self.endpoints.get(path)
+        if limit is None:
+            limit = EndpointLimit(
+                *STEAM_ENDPOINT_LIMITS.get(path, STEAM_DEFAULT_ENDPOINT_LIMIT)
+            )
+            self.endpoints[path] = limit
+        return limit
+
+    async def acquire(self, path: str) -> EndpointLimit:
+        limit = self.get_limit(path)
+        start = time.monotonic()
+        await limit.semaphore.acquire()
+        try:
+            while True:
+                now = time.monotonic()
+                delay = max(self.shared.wait_time(now), limit.bucket.wait_time(now))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+        except BaseException:
+            limit.semaphore.release()
+            raise
+        self.shared.tokens -= 1
+        limit.bucket.tokens -= 1
+        wait = time.monotonic() - start
+        limit.requests += 1
+        limit.wait_total += wait
+        limit.wait_max = max(limit.wait_max, wait)
+        return limit
+
+    async def middleware(
+        self, request: aiohttp.ClientRequest, handler: aiohttp.ClientHandlerType
+    ) -> aiohttp.ClientResponse:
+        limit = await self.acquire(request.url.path)
+        try:
+            return await handler(request)
+        finally:
+            limit.semaphore.release()
+
+    def report_waits(self):
+        """
+        Prints the queue wait of each endpoint since the last report.
+        """
+        for path, limit in self.endpoints.items():
+            if not limit.requests:
+                continue
+            print(
+                f"{path}: {limit.requests} requests, queued"
+                f" {limit.wait_total / limit.requests:.3f}s avg,"
+                f" {limit.wait_max:.3f}s max"
+            )
+            limit.requests = 0
+            limit.wait_total = 0.0
+            limit.wait_max = 0.0
+
+
+steam_rate_limiter = SteamRateLimiter()
+
+
 next_overview_resp_time = 0
 last_server_version = 0
 
@@ -162,6 +1483,51 @@ def by_value(x):
     return x[1]
 
 
+def parse_steam_response(body: bytes):
+    """
+    Parses a Steam API response straight from bytes.
+    Server names can carry invalid UTF-8, which is only repaired if parsing fails.
+    """
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return orjson.loads(body.decode("utf-8", errors="replace"))
+
+
+class ServerInfo(NamedTuple):
+    """
+    The parts of a server list entry that are collected.
+    """
+
+    addr: str
+    steamid: str
+    name: str
+    appid: int
+    gamedir: str
+    product: str
+    version: str
+    players: int
+    max_players: int
+    map: str | None
+    gametype: str
+
+    @classmethod
+    def from_steam(cls, server: dict) -> "ServerInfo":
+        return cls(
+            server["addr"],
+            server["steamid"],
+            server["name"],
+            server["appid"],
+            server["gamedir"],
+            server["product"],
+            server["version"],
+            server["players"],
+            server["max_players"],
+            server.get("map"),
+            server.get("gametype", ""),
+        )
+
+
 async def query_runner(
     api_session: aiohttp.ClientSession, comfig_session: aiohttp.ClientSession
 ):
@@ -175,6 +1541,16 @@ async def query_runner(
     banned_ids = set(get_value("ids", default=[], table=ban_table))
     pending_servers = []
     query_intervals = []
+    store = SightingStore(SIGHTINGS_DB_PATH)
+    store.load()
+    sightings = SightingTracker()
+    timeseries = TimeSeriesLog(TIMESERIES_PATH)
+    next_export_time = 0
+    export_requested = asyncio.Event()
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, export_requested.set
+        )
     while True:
         if len(query_intervals) == 0:
             query_1 = QUERY_INTERVAL + chaos(QUERY_INTERVAL_VARIANCE)
@@ -190,60 +1566,66 @@ async def query_runner(
                         "/IGameServersService/GetServerList/v1/",
                         params=server_params,
                     ) as resp:
-                        body = await resp.read()
-                        body = body.decode("utf-8", errors="replace")
-                        body = orjson.loads(body)
-                        pending_servers = body["response"]["servers"]
+                        body = parse_steam_response(await resp.read())
+                        pending_servers = [
+                            ServerInfo.from_steam(server)
+                            for server in body["response"]["servers"]
+                        ]
                 except:
                     traceback.print_exc()
 
                 now = utcnow().timestamp()
                 current_counts = defaultdict(int)
+                map_weights = defaultdict(int)
+                server_weights = defaultdict(int)
+                tag_weights = defaultdict(int)
+                for uniques in UNIQUE_SCOPES.values():
+                    uniques.expire(now)
 
                 async def calc_server(server):
+                    global counted_players
                     count_players = True
                     # not tf, leave
-                    if server["appid"] != APP_ID:
+                    if server.appid != APP_ID:
                         return 0
-                    if server["gamedir"] != APP_NAME:
+                    if server.gamedir != APP_NAME:
                         return 0
-                    if server["product"] != APP_NAME:
+                    if server.product != APP_NAME:
                         return 0
-                    num_players = server["players"]
+                    num_players = server.players
                     if num_players < 2:
                         count_players = False
-                    max_players = server["max_players"]
+                    max_players = server.max_players
                     if max_players < 6:
                         count_players = False
                     # check if out of date
-                    if int(server["version"]) < server_version:
+                    if int(server.version) < server_version:
                         count_players = False
                     # check for map
-                    map = server.get("map")
+                    map = server.map
                     if not map:
                         count_players = False
                     # check for ban
-                    steamid = server["steamid"]
+                    steamid = server.steamid
                     if steamid in banned_ids:
                         return 0
-                    addr = server["addr"]
+                    addr = server.addr
                     ip, port = addr.split(":")
                     if ip in banned_ips:
                         return 0
-                    bots = server["bots"]
                     players = []
                     name = (
-                        server["name"]
-                        .replace("\u0001", "")
+                        server.name.replace("\u0001", "")
                         .replace("\t", "")
                         .replace(r"\N", "")
                         .encode("raw_unicode_escape")
                         .decode("unicode_escape")
                         .strip()
                     )
-                    gametypes = server.get("gametype", "").lower().split(",")
+                    gametypes = server.gametype.lower().split(",")
                     for gametype in gametypes:
                         tags[gametype] += 1
+                        sightings.tags.add(gametype)
                     if addr.startswith("169.254"):
                         ip_address = ipaddress.ip_address(ip)
                         fake_ip = int(ip_address)
@@ -257,9 +1639,7 @@ async def query_runner(
                                 "query_type": 2,
                             },
                         ) as resp:
-                            body = await resp.read()
-                            body = body.decode("utf-8", errors="replace")
-                            body = orjson.loads(body)
+                            body = parse_steam_response(await resp.read())
                             players_query = body["response"]["players_data"].get(
                                 "players", []
                             )
@@ -281,27 +1661,65 @@ async def query_runner(
                         ):
                             count_ahead = 3 if player[2] == ")" else 4
                             player = player[count_ahead:]
-                        if count_players or player in player_names:
-                            player_names[player] = now
-                        all_player_names[player] = now
-                        current_counts[player] += 1
-                        map_players[map].add(player)
-                        player_maps[player].add(map)
-                        server_players[name].add(player)
-                        player_servers[player].add(name)
+                        player_id = intern_player(player)
+                        if count_players or player_counted_seen[player_id]:
+                            if not player_counted_seen[player_id]:
+                                counted_players += 1
+                            player_counted_seen[player_id] = now
+                        if RETENTION:
+                            last_seen_index.update(
+                                player_id, player_seen[player_id], now
+                            )
+                        player_seen[player_id] = now
+                        current_counts[player_id] += 1
+                        sightings.players.add(player_id)
+                        if map:
+                            map_id = sightings.intern_map(map)
+                            if player_maps.add(player_id, map_id):
+                                sightings.map_edges.append((player_id, map_id))
+                        server_id = sightings.intern_server(name)
+                        if player_servers.add(player_id, server_id):
+                            sightings.server_edges.append((player_id, server_id))
+                        # counted servers always have a map
+                        if count_players:
+                            hashed = player_hashes[player_id]
+                            unique_players.add(0, hashed, now)
+                            map_unique_players.add(map_id, hashed, now)
+                            server_unique_players.add(server_id, hashed, now)
 
                     server_capacities[str(max_players)] += 1
+                    sightings.capacities.add(str(max_players))
+
+                    if map:
+                        map_weights[map] += num_players
+                    server_weights[name] += num_players
+                    for gametype in gametypes:
+                        tag_weights[gametype] += num_players
 
                     return num_players
 
                 server_infos = await asyncio.gather(
                     *[calc_server(server) for server in pending_servers]
                 )
-                for player, count in current_counts.items():
-                    player_counts[player] = max(player_counts[player], count)
+                for player_id, count in current_counts.items():
+                    player_counts[player_id] = max(player_counts[player_id], count)
+                await output_writer.submit(store.write, sightings.take())
+                if RETENTION:
+                    evicted, records = evict_players(now - RETENTION)
+                    if evicted:
+                        print("Evicted Players:", len(evicted))
+                        if records:
+                            await output_writer.submit(
+                                archive_players, Path(ARCHIVE_PATH), records
+                            )
+                        await output_writer.submit(store.evict, evicted)
+                top_maps.add_cycle(map_weights, now)
+                top_servers.add_cycle(server_weights, now)
+                top_tags.add_cycle(tag_weights, now)
                 players = sum(server_infos)
                 print("Concurrent Players:", players)
 
+                steam_players = -1
                 try:
                     async with api_session.get(
                         "/ISteamUserStats/GetNumberOfCurrentPlayers/v1/",
@@ -309,69 +1727,79 @@ async def query_runner(
                     ) as resp:
                         body = await resp.read()
                         body = orjson.loads(body)
-                        print("Online Players:", body["response"]["player_count"])
+                        steam_players = body["response"]["player_count"]
+                        print("Online Players:", steam_players)
                 except:
                     traceback.print_exc()
+                await output_writer.submit(
+                    timeseries.write,
+                    now,
+                    players,
+                    steam_players,
+                    {
+                        "maps": map_weights,
+                        "servers": server_weights,
+                        "tags": tag_weights,
+                    },
+                )
 
-                print("Unique Players:", len(player_names))
+                print("Unique Players:", counted_players)
+                estimates = estimate_uniques(unique_players.copy())
+                for window, estimate in estimates.get(0, EMPTY_DICT).items():
+                    print(f"Unique Players ({window}):", estimate)
+                steam_rate_limiter.report_waits()
 
-                with open("all_players.json", "wb") as fp:
-                    players = []
-                    player_list = list(all_player_names.keys())
-                    player_list.sort()
-                    for player in player_list:
-                        last_seen = all_player_names[player]
-                        max_count = player_counts[player]
-                        maps = list(player_maps[player])
-                        servers = list(player_servers[player])
-                        players.append(
-                            {
-                                "name": player,
-                                "count": max_count,
-                                "seen": last_seen,
-                                "maps": maps,
-                                "servers": servers,
-                            }
-                        )
-                    fp.write(orjson.dumps(players, option=orjson.OPT_INDENT_2))
-
-                with open("players.json", "wb") as fp:
-                    players = []
-                    player_list = list(player_names.keys())
-                    player_list.sort()
-                    for player in player_list:
-                        last_seen = player_names[player]
-                        max_count = player_counts[player]
-                        maps = list(player_maps[player])
-                        servers = list(player_servers[player])
-                        players.append(
-                            {
-                                "name": player,
-                                "count": max_count,
-                                "seen": last_seen,
-                                "maps": maps,
-                                "servers": servers,
-                            }
-                        )
-                    fp.write(orjson.dumps(players, option=orjson.OPT_INDENT_2))
-                with open("server_stats.json", "wb") as fp:
-                    s2p = {}
-                    for server, players in server_players.items():
-                        s2p[server] = len(players)
-                    s2p = dict(sorted(s2p.items(), key=by_value))
-                    my_tags = dict(sorted(tags.items(), key=by_value))
-                    my_caps = dict(sorted(server_capacities.items(), key=by_value))
-                    m2p = {}
-                    for map, players in map_players.items():
-                        m2p[map] = len(players)
-                    m2p = dict(sorted(m2p.items(), key=by_value))
-                    stats = {
-                        "tags": my_tags,
-                        "caps": my_caps,
-                        "players": s2p,
-                        "maps": m2p,
-                    }
-                    fp.write(orjson.dumps(stats, option=orjson.OPT_INDENT_2))
+                current_time = time.monotonic()
+                if export_requested.is_set() or current_time >= next_export_time:
+                    export_requested.clear()
+                    next_export_time = current_time + EXPORT_INTERVAL
+                    await output_writer.submit(
+                        store.export_players, Path("all_players.json"), False
+                    )
+                    await output_writer.submit(
+                        store.export_players, Path("players.json"), True
+                    )
+                    await output_writer.submit(
+                        write_unique_players,
+                        Path("unique_players.json"),
+                        {
+                            scope: uniques.copy()
+                            for scope, uniques in UNIQUE_SCOPES.items()
+                        },
+                        list(map_ids.names),
+                        list(server_ids.names),
+                    )
+                # evicted players can leave servers and maps with no players, and
+                # the names of some IDs may have been lost before they were written
+                s2p = {
+                    name: count
+                    for name, count in zip(server_ids.names, player_servers.counts)
+                    if count and name is not None
+                }
+                s2p = dict(sorted(s2p.items(), key=by_value))
+                my_tags = dict(sorted(tags.items(), key=by_value))
+                my_caps = dict(sorted(server_capacities.items(), key=by_value))
+                m2p = {
+                    name: count
+                    for name, count in zip(map_ids.names, player_maps.counts)
+                    if count and name is not None
+                }
+                m2p = dict(sorted(m2p.items(), key=by_value))
+                stats = {
+                    "tags": my_tags,
+                    "caps": my_caps,
+                    "players": s2p,
+                    "maps": m2p,
+                }
+                await output_writer.submit(write_json, Path("server_stats.json"), stats)
+                top_stats = {
+                    "maps": top_maps.report(),
+                    "servers": top_servers.report(),
+                    "tags": top_tags.report(),
+                }
+                await output_writer.submit(
+                    write_json, Path("top_stats.json"), top_stats
+                )
 
         except Exception:
             traceback.print_exc()
@@ -387,7 +1815,9 @@ def encode_json(obj):
 
 async def main():
     async with aiohttp.ClientSession(
-        base_url="https://api.steampowered.com", raise_for_status=True
+        base_url="https://api.steampowered.com",
+        raise_for_status=True,
+        middlewares=(steam_rate_limiter.middleware,),
     ) as api_session:
         async with aiohttp.ClientSession(
             base_url=COMFIG_API_URL, json_serialize=encode_json